@@ -0,0 +1,431 @@
+"""
+backup.py
+
+Online backup and snapshot service for the SQLite database.
+
+Snapshots are copied with the SQLite backup API a few pages at a time,
+sleeping between steps, so the database is never locked for the whole
+copy and checkouts keep running while a backup is in progress.
+
+Command line usage (run from the my_flask_app folder):
+    python -m app.backup snapshot
+    python -m app.backup list
+    python -m app.backup restore snapshot-20251031-120000.db
+Add --store <store_id> to work on a store other than the default one.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict
+
+from flask import Blueprint, jsonify
+
+from app.helper import DEFAULT_STORE, get_base_dir, get_current_store, \
+    get_db_path, list_stores
+
+# Pages copied per backup step and pause between steps. Small steps
+# keep each read lock short so writers only wait a few milliseconds.
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_SLEEP = 0.005
+
+# A write from another connection restarts a stepped backup from the
+# first page. In WAL mode, after this many restarts the rest is copied
+# in one step, which only holds a read snapshot and never blocks
+# writers. Without WAL one step would lock out writers for the whole
+# copy, so the backup keeps stepping instead.
+BACKUP_MAX_RESTARTS = 3
+
+# Scheduled snapshot defaults (seconds / number of files kept)
+SNAPSHOT_INTERVAL = 3600
+SNAPSHOT_RETENTION = 24
+SNAPSHOT_PREFIX = 'snapshot-'
+
+# Number of recent samples kept for each metric
+METRIC_SAMPLES = 500
+
+
+# -----------------------------
+# Metrics
+# -----------------------------
+
+def _summarize(samples):
+    """
+    Return count, average, p95 and max (in milliseconds) of samples.
+    """
+    if not samples:
+        return {'count': 0, 'avg_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return {
+        'count': len(ordered),
+        'avg_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p95_ms': round(p95 * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+class _BackupRestarted(Exception):
+    """
+    Raised from the progress callback to abandon a stepped backup.
+    """
+
+
+class BackupMetrics:
+    """
+    Thread-safe counters for backup duration and checkout latency.
+
+    Checkout latencies are split by whether a backup was running, so
+    the cost a backup adds to the till can be read off directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self.backupsRun = 0
+        self.backupsFailed = 0
+        self.backupDurations = deque(maxlen=METRIC_SAMPLES)
+        self.checkoutIdle = deque(maxlen=METRIC_SAMPLES)
+        self.checkoutDuringBackup = deque(maxlen=METRIC_SAMPLES)
+
+    def backup_started(self):
+        with self._lock:
+            self._active += 1
+
+    def backup_finished(self, duration, ok=True):
+        with self._lock:
+            self._active -= 1
+            if ok:
+                self.backupsRun += 1
+                self.backupDurations.append(duration)
+            else:
+                self.backupsFailed += 1
+
+    def backup_in_progress(self):
+        with self._lock:
+            return self._active > 0
+
+    def record_checkout(self, seconds):
+        with self._lock:
+            if self._active:
+                self.checkoutDuringBackup.append(seconds)
+            else:
+                self.checkoutIdle.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'backup_in_progress': self._active > 0,
+                'backups_run': self.backupsRun,
+                'backups_failed': self.backupsFailed,
+                'backup_duration': _summarize(list(self.backupDurations)),
+                'checkout_latency_idle':
+                    _summarize(list(self.checkoutIdle)),
+                'checkout_latency_during_backup':
+                    _summarize(list(self.checkoutDuringBackup)),
+            }
+
+
+METRICS = BackupMetrics()
+
+
+def record_checkout_latency(seconds):
+    """
+    Record how long one checkout took (called by sales.sell_products).
+    """
+    METRICS.record_checkout(seconds)
+
+
+# -----------------------------
+# Backup functions
+# -----------------------------
+
+def _ensure_wal(conn):
+    """
+    Switch the database to WAL mode if it is not; return whether it is.
+    """
+    try:
+        mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    except sqlite3.OperationalError:
+        # Another connection kept the database busy; try next backup
+        return False
+    return mode.lower() == 'wal'
+
+
+def online_backup(sourcePath, targetPath, pages=BACKUP_PAGES_PER_STEP,
+                  stepSleep=BACKUP_STEP_SLEEP,
+                  maxRestarts=BACKUP_MAX_RESTARTS):
+    """
+    Copy a live SQLite database to targetPath without blocking writers.
+
+    The copy is written to a temporary file first and renamed when
+    complete, so a crash never leaves a torn file under the target name.
+    The source is switched to WAL mode first. If writes then keep
+    restarting the stepped copy, it is finished in a single step so a
+    busy shop cannot keep a backup running forever. Returns the time the
+    copy took in seconds.
+    """
+    tmpPath = targetPath + '.partial'
+    started = time.perf_counter()
+    METRICS.backup_started()
+    ok = False
+    src = sqlite3.connect(sourcePath)
+    dst = sqlite3.connect(tmpPath)
+    try:
+        walMode = _ensure_wal(src)
+        restarts = 0
+        lastRemaining = None
+
+        # Sleeping in the progress callback releases the source lock
+        # between steps so checkouts can commit in the gaps. More pages
+        # left than after the previous step means a write restarted it.
+        def progress(status, remaining, total):
+            nonlocal restarts, lastRemaining
+            if lastRemaining is not None and remaining > lastRemaining:
+                restarts += 1
+                if walMode and restarts > maxRestarts:
+                    raise _BackupRestarted()
+            lastRemaining = remaining
+            if remaining and stepSleep:
+                time.sleep(stepSleep)
+
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except _BackupRestarted:
+            src.backup(dst, pages=-1)
+        dst.close()
+        os.replace(tmpPath, targetPath)
+        ok = True
+    finally:
+        src.close()
+        dst.close()
+        if not ok and os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        duration = time.perf_counter() - started
+        METRICS.backup_finished(duration, ok)
+    return duration
+
+
+class BackupService:
+    """
+    Take, list, prune and restore snapshots of the shop database.
+    """
+
+    def __init__(self, storeId=DEFAULT_STORE, dbPath=None, snapshotDir=None,
+                 retention=SNAPSHOT_RETENTION):
+        self.storeId = storeId
+        self.dbPath = dbPath
+        self.snapshotDir = snapshotDir
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get_db_path(self):
+        return self.dbPath or get_db_path(self.storeId)
+
+    def get_snapshot_dir(self):
+        if self.snapshotDir:
+            return self.snapshotDir
+        snapshotDir = os.path.join(get_base_dir(), 'database', 'snapshots')
+        if self.storeId == DEFAULT_STORE:
+            return snapshotDir
+        return os.path.join(snapshotDir, self.storeId)
+
+    def snapshot(self):
+        """
+        Take one snapshot, prune old ones and describe the new file.
+        """
+        snapshotDir = self.get_snapshot_dir()
+        os.makedirs(snapshotDir, exist_ok=True)
+        name = f"{SNAPSHOT_PREFIX}{datetime.now():%Y%m%d-%H%M%S-%f}.db"
+        path = os.path.join(snapshotDir, name)
+
+        # One backup at a time; a second copy would only double the load
+        with self._lock:
+            duration = online_backup(self.get_db_path(), path)
+            self.prune()
+
+        return {
+            'name': name,
+            'size_bytes': os.path.getsize(path),
+            'duration_ms': round(duration * 1000, 2),
+        }
+
+    def list_snapshots(self):
+        """
+        Return snapshot descriptions, newest first.
+        """
+        snapshotDir = self.get_snapshot_dir()
+        if not os.path.isdir(snapshotDir):
+            return []
+        names = sorted(
+            (n for n in os.listdir(snapshotDir)
+             if n.startswith(SNAPSHOT_PREFIX) and n.endswith('.db')),
+            reverse=True,
+        )
+        return [
+            {
+                'name': n,
+                'size_bytes': os.path.getsize(os.path.join(snapshotDir, n)),
+            }
+            for n in names
+        ]
+
+    def prune(self):
+        """
+        Delete snapshots beyond the retention count, oldest first.
+        """
+        snapshotDir = self.get_snapshot_dir()
+        for old in self.list_snapshots()[self.retention:]:
+            os.remove(os.path.join(snapshotDir, old['name']))
+
+    def restore(self, name):
+        """
+        Overwrite the live database with the named snapshot.
+
+        The restore runs as a single backup step so readers never see a
+        half-restored database; it should be run while the shop is idle.
+        """
+        if os.path.basename(name) != name or \
+                not name.startswith(SNAPSHOT_PREFIX):
+            raise ValueError(f'Invalid snapshot name: {name!r}')
+        path = os.path.join(self.get_snapshot_dir(), name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'Snapshot not found: {name}')
+
+        with self._lock:
+            src = sqlite3.connect(path)
+            dst = sqlite3.connect(self.get_db_path())
+            try:
+                src.backup(dst, pages=-1)
+            finally:
+                src.close()
+                dst.close()
+        return {'restored': name}
+
+    def start(self, interval=SNAPSHOT_INTERVAL):
+        """
+        Start taking snapshots every interval seconds in the background.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.snapshot()
+                except (sqlite3.Error, OSError) as e:
+                    print(f'[ERROR] Scheduled snapshot failed: {e}')
+
+        self._thread = threading.Thread(
+            target=loop, name=f'snapshot-scheduler-{self.storeId}',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background snapshot thread.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+# One backup service per store, created on first use
+_services: Dict[str, BackupService] = {}
+_servicesLock = threading.Lock()
+
+
+def get_backup_service(storeId=None):
+    """
+    Return the backup service of a store (default: the current request's).
+    """
+    if storeId is None:
+        storeId = get_current_store()
+    with _servicesLock:
+        service = _services.get(storeId)
+        if service is None:
+            service = _services[storeId] = BackupService(storeId)
+    return service
+
+
+def start_backup_schedules(interval=SNAPSHOT_INTERVAL):
+    """
+    Start scheduled snapshots for every store.
+    """
+    for storeId in list_stores():
+        get_backup_service(storeId).start(interval)
+
+
+# -----------------------------
+# Blueprint
+# -----------------------------
+backup_bp = Blueprint('backup', __name__, url_prefix='/api/backup')
+
+
+@backup_bp.route('/snapshots', methods=['GET'])
+def listSnapshots():
+    """
+    Endpoint to list available snapshots.
+    """
+    return jsonify(get_backup_service().list_snapshots()), 200
+
+
+@backup_bp.route('/snapshots', methods=['POST'])
+def createSnapshot():
+    """
+    Endpoint to take a snapshot now.
+    """
+    try:
+        return jsonify(get_backup_service().snapshot()), 201
+    except (sqlite3.Error, OSError) as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@backup_bp.route('/metrics', methods=['GET'])
+def backupMetrics():
+    """
+    Endpoint to report backup duration and checkout latency metrics.
+    """
+    return jsonify(METRICS.summary()), 200
+
+
+# -----------------------------
+# Command line
+# -----------------------------
+
+def main(argv):
+    """
+    Run a snapshot, list or restore command from the command line.
+    """
+    storeId = DEFAULT_STORE
+    if len(argv) >= 2 and argv[-2] == '--store':
+        storeId = argv[-1]
+        argv = argv[:-2]
+    if not argv or argv[0] not in ('snapshot', 'list', 'restore'):
+        print(__doc__)
+        return 2
+    backup_service = get_backup_service(storeId)
+    if argv[0] == 'snapshot':
+        print(backup_service.snapshot())
+    elif argv[0] == 'list':
+        for snap in backup_service.list_snapshots():
+            print(f"{snap['name']}  {snap['size_bytes']} bytes")
+    else:
+        if len(argv) != 2:
+            print('Usage: python -m app.backup restore <snapshot-name>')
+            return 2
+        print(backup_service.restore(argv[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,179 @@
+"""
+federation.py
+
+Chain-wide sales reports across all store shards.
+
+The sales_report queries run on every store database in a process
+pool, one task per store, and the partial results are merged here. Each
+store is read by its own process, so a report over many stores uses
+every core instead of reading the shards one after another.
+"""
+
+import multiprocessing
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Blueprint, jsonify, request
+
+from app.helper import get_db_path, list_stores, validate_store_id
+from app.sales_report import build_sales_report_sql, build_transactions_sql
+
+chain_report_bp = Blueprint(
+    'chain_report', __name__, url_prefix='/sales-report/chain'
+)
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the shared report process pool, starting it on first use.
+
+    Workers are spawned rather than forked: the server is multi-threaded
+    (request threads, journal appliers, snapshot schedulers), and a
+    forked child could inherit a lock held by one of them. Spawning is
+    also what a PyInstaller build does.
+    """
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+
+# -----------------------------
+# Per-shard work (runs in the pool)
+# -----------------------------
+
+def _run_shard_query(dbPath, sql, params):
+    """
+    Run one report query on one store database, read-only.
+    """
+    conn = sqlite3.connect(f'file:{dbPath}?mode=ro', uri=True)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def _run_on_shards(storeIds, sql, params):
+    """
+    Run the query on every store and return the per-store row lists.
+    """
+    paths = [get_db_path(storeId) for storeId in storeIds]
+    if len(paths) == 1:
+        # Not worth a round trip to another process
+        return [_run_shard_query(paths[0], sql, params)]
+    futures = [
+        get_pool().submit(_run_shard_query, path, sql, params)
+        for path in paths
+    ]
+    return [future.result() for future in futures]
+
+
+# -----------------------------
+# Merging
+# -----------------------------
+
+def federated_sales_report(storeIds, start_date=None, end_date=None,
+                           group_by='daily'):
+    """
+    Return revenue and quantity per period summed over the stores.
+    """
+    sql, params = build_sales_report_sql(start_date, end_date, group_by)
+    merged = {}
+    for rows in _run_on_shards(storeIds, sql, params):
+        for period, groupKey, amount, quantity in rows:
+            if quantity is None:
+                # Store with no sales in the range
+                continue
+            total = merged.get(groupKey)
+            if total is None:
+                merged[groupKey] = [period, amount or 0, quantity]
+            else:
+                total[0] = min(total[0], period)
+                total[1] += amount or 0
+                total[2] += quantity
+    return [
+        {
+            'period': merged[key][0],
+            'total_amount': merged[key][1],
+            'total_quantity': merged[key][2],
+        }
+        for key in sorted(merged)
+    ]
+
+
+def federated_transactions(storeIds, start_date=None, end_date=None):
+    """
+    Return quantity and subtotal per day, product and price summed over
+    the stores.
+    """
+    sql, params = build_transactions_sql(start_date, end_date)
+    merged = {}
+    for rows in _run_on_shards(storeIds, sql, params):
+        for period, name, quantity, price, subtotal in rows:
+            total = merged.setdefault((period, name, price), [0, 0])
+            total[0] += quantity
+            total[1] += subtotal
+    return [
+        {
+            'period': period,
+            'name': name,
+            'quantity': merged[(period, name, price)][0],
+            'price': price,
+            'subtotal': merged[(period, name, price)][1],
+        }
+        for period, name, price in sorted(merged)
+    ]
+
+
+def _requested_stores():
+    """
+    Return the stores named in the 'stores' argument, or every store.
+    """
+    arg = (request.args.get('stores') or '').strip()
+    if not arg:
+        return list_stores()
+    return [validate_store_id(s.strip()) for s in arg.split(',') if s.strip()]
+
+
+# -----------------------------
+# Blueprint
+# -----------------------------
+
+@chain_report_bp.route('/report-json')
+def chain_sales_report_json():
+    """
+    Endpoint for the sales report of the whole chain (or ?stores=a,b).
+    """
+    try:
+        storeIds = _requested_stores()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(federated_sales_report(
+        storeIds,
+        request.args.get('from'),
+        request.args.get('to'),
+        request.args.get('group', 'daily'),
+    ))
+
+
+@chain_report_bp.route('/transactions-json')
+def chain_transactions_json():
+    """
+    Endpoint for the transactions report of the whole chain.
+    """
+    try:
+        storeIds = _requested_stores()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(federated_transactions(
+        storeIds, request.args.get('from'), request.args.get('to')
+    ))
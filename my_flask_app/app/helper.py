@@ -2,39 +2,173 @@
 helper.py
 
 Database connection helper for the application.
-Handles path detection for both normal and PyInstaller execution.
+Handles path detection for both normal and PyInstaller execution, and
+picks the database shard of the store a request is for.
 """
 
 import sqlite3
 import os
+import re
 import sys
+import threading
+from datetime import datetime, timedelta
+from typing import Set
 
+from flask import has_request_context, request
 
-def get_connection():
+# The original single-shop database is the 'default' store; every other
+# store has its own file in database/stores/<store_id>.db
+DEFAULT_STORE = 'default'
+STORE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+# Tables added after the first release, created on first use of each
+# database file so older shop databases keep working
+SCHEMA_UPGRADES = [
+    """
+    CREATE TABLE IF NOT EXISTS checkout_request (
+      request_key TEXT PRIMARY KEY,
+      request_hash TEXT NOT NULL,
+      transaction_id INTEGER NOT NULL,
+      response TEXT NOT NULL,
+      created_at DATETIME NOT NULL,
+      FOREIGN KEY (transaction_id) REFERENCES total_transaction(transaction_id)
+    )
+    """,
+]
+
+# A stored checkout result only has to outlive the till's retries of
+# that checkout; older ones are deleted
+CHECKOUT_REQUEST_RETENTION = timedelta(days=7)
+
+_upgradedPaths: Set[str] = set()
+_upgradeLock = threading.Lock()
+
+
+def get_base_dir():
+    """
+    Return the directory that holds the 'database' folder.
+
+    Uses the PyInstaller temporary directory when running from a bundle,
+    otherwise the parent directory of this package.
+    """
+    if getattr(sys, 'frozen', False):
+        # If running from a PyInstaller bundle, use the temporary directory
+        return sys._MEIPASS
+    # If running normally, use the parent directory of the current file
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_stores_dir():
+    """
+    Return the folder holding the database files of additional stores.
+    """
+    return os.path.join(get_base_dir(), 'database', 'stores')
+
+
+def list_stores():
+    """
+    Return the ids of all stores that have a database, default first.
+    """
+    stores = [DEFAULT_STORE]
+    storesDir = get_stores_dir()
+    if os.path.isdir(storesDir):
+        stores += sorted(
+            name[:-3] for name in os.listdir(storesDir)
+            if name.endswith('.db') and STORE_ID_PATTERN.match(name[:-3])
+            and name[:-3] != DEFAULT_STORE
+        )
+    return stores
+
+
+def validate_store_id(storeId):
+    """
+    Return storeId if it names an existing store, else raise ValueError.
+    """
+    if not storeId or not STORE_ID_PATTERN.match(storeId):
+        raise ValueError(f'Invalid store id: {storeId!r}')
+    if storeId != DEFAULT_STORE and \
+            not os.path.exists(get_db_path(storeId)):
+        raise ValueError(f'Unknown store: {storeId}')
+    return storeId
+
+
+def get_current_store():
+    """
+    Return the store the current request is for.
+
+    The store comes from the X-Store-Id header or the 'store' query
+    argument; outside a request, or when neither is given, it is the
+    default store.
+    """
+    if not has_request_context():
+        return DEFAULT_STORE
+    storeId = request.headers.get('X-Store-Id') or request.args.get('store')
+    if not storeId:
+        return DEFAULT_STORE
+    return validate_store_id(storeId.strip())
+
+
+def get_db_path(storeId=None):
+    """
+    Return the full path of a store's SQLite database file.
+
+    With no storeId, the store of the current request is used.
+    """
+    if storeId is None:
+        storeId = get_current_store()
+    if storeId == DEFAULT_STORE:
+        return os.path.join(get_base_dir(), 'database', 'mydatabase.db')
+    return os.path.join(get_stores_dir(), f'{storeId}.db')
+
+
+def connect_db(dbPath, **kwargs):
+    """
+    Open a database file with Row results and an up-to-date schema.
+    """
+    conn = sqlite3.connect(dbPath, **kwargs)
+    conn.row_factory = sqlite3.Row
+    if dbPath not in _upgradedPaths:
+        with _upgradeLock:
+            if dbPath not in _upgradedPaths:
+                for sql in SCHEMA_UPGRADES:
+                    conn.execute(sql)
+                prune_checkout_requests(conn)
+                conn.commit()
+                _upgradedPaths.add(dbPath)
+    return conn
+
+
+def prune_checkout_requests(conn, now=None):
+    """
+    Delete checkout results older than CHECKOUT_REQUEST_RETENTION.
+
+    Runs when a database is first opened and every so often as results
+    are stored (see sales.store_checkout_result). Returns the number of
+    rows deleted.
+    """
+    cutoff = (now or datetime.now()) - CHECKOUT_REQUEST_RETENTION
+    cur = conn.execute(
+        'DELETE FROM checkout_request WHERE created_at < ?',
+        (cutoff.isoformat(timespec='seconds'),),
+    )
+    return cur.rowcount
+
+
+def get_connection(storeId=None):
     """
     Establish and return a SQLite database connection.
 
     This function determines the correct base directory depending on whether the
     program is running normally or from a PyInstaller bundle, then connects to
-    the SQLite database file located in the 'database' folder.
+    the SQLite database file of the store (by default the store of the
+    current request) located in the 'database' folder.
     """
     try:
-        if getattr(sys, 'frozen', False):
-            # If running from a PyInstaller bundle, use the temporary directory
-            baseDir = sys._MEIPASS
-        else:
-            # If running normally, use the parent directory of the current file
-            baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-        dbPath = os.path.join(baseDir, 'database', 'mydatabase.db')
+        dbPath = get_db_path(storeId)
         print(f'[DEBUG] Using database path: {dbPath}')
 
-        conn = sqlite3.connect(dbPath)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return connect_db(dbPath)
 
     except Exception as e:
         print(f'[ERROR] Failed to connect to DB: {e}')
         raise
-
-
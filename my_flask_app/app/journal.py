@@ -0,0 +1,582 @@
+"""
+journal.py
+
+Write-ahead sale journal that sits in front of the SQLite database.
+
+Checkout validates against an in-memory stock view, appends the sale to
+an fsynced journal file and returns straight away. A background applier
+thread drains the journal into total_transaction, each_transaction and
+product in batched transactions, so a long report or a backup holding
+the database never makes the customer wait at the till.
+
+Cache misses and idempotency checks still read the database, so it is
+switched to WAL mode on start, where readers never wait for a writer.
+Every batch records the last applied journal sequence number in the
+sale_journal_state table inside the same transaction, so on start up
+the journal replays exactly the sales that had not been applied.
+
+A sale the database refuses (for example a CHECK constraint on stock)
+is moved to a dead-letter file next to the journal and skipped, so one
+bad entry cannot hold up every sale behind it.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict
+
+from app.helper import DEFAULT_STORE, connect_db, get_base_dir, \
+    get_current_store, get_db_path, get_stores_dir, list_stores
+
+# Sales written to the database per applier transaction
+JOURNAL_BATCH_SIZE = 50
+
+# Seconds the applier waits before retrying a failed batch (doubles on
+# each failure up to the maximum)
+APPLY_RETRY_DELAY = 0.05
+APPLY_RETRY_MAX_DELAY = 2.0
+
+# Seconds a connection waits for a database lock
+DB_TIMEOUT = 30
+
+# Errors that retrying an entry can never fix; such an entry is moved to
+# the dead-letter file instead of being retried
+UNAPPLIABLE_ERRORS = (
+    sqlite3.IntegrityError, sqlite3.DataError, KeyError, TypeError,
+)
+
+
+class SaleJournal:
+    """
+    Durable append-only log of sales plus the applier that drains it.
+    """
+
+    def __init__(self, storeId=DEFAULT_STORE, dbPath=None, journalPath=None,
+                 batchSize=JOURNAL_BATCH_SIZE):
+        self.storeId = storeId
+        self.dbPath = dbPath
+        self.journalPath = journalPath
+        self.batchSize = batchSize
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._file = None
+        self._reader = None
+        self._thread = None
+        self._stopping = False
+
+        # Journal entries not yet applied, oldest first
+        self._pending = deque()
+        # Quantity per product_id held by pending entries
+        self._pendingQty = {}
+        # request_key -> (request_hash, result) for pending entries
+        self._pendingKeys = {}
+        # product_id -> cached product row and the journal sequence
+        # number that row already includes
+        self._stock = {}
+        self._nextSeq = 1
+        self._nextTransactionId = 1
+
+        self.appliedSeq = 0
+        self.appliedTotal = 0
+        self.lastBatchSize = 0
+        self.lastApplyMs = 0.0
+        self.lastError = None
+        self.deadLetters = 0
+        self.lastDeadLetter = None
+
+    # -----------------------------
+    # Paths and connections
+    # -----------------------------
+
+    def get_db_path(self):
+        return self.dbPath or get_db_path(self.storeId)
+
+    def get_journal_path(self):
+        if self.journalPath:
+            return self.journalPath
+        if self.storeId == DEFAULT_STORE:
+            return os.path.join(get_base_dir(), 'database', 'sale_journal.log')
+        return os.path.join(get_stores_dir(), f'{self.storeId}.journal')
+
+    def get_dead_letter_path(self):
+        return os.path.splitext(self.get_journal_path())[0] + '.dead'
+
+    def _connect(self):
+        return connect_db(
+            self.get_db_path(), timeout=DB_TIMEOUT, check_same_thread=False
+        )
+
+    # -----------------------------
+    # Start up and recovery
+    # -----------------------------
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Recover unapplied sales from the journal and start the applier.
+        """
+        if self.is_running():
+            return
+        with self._lock:
+            self._recover()
+            self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name='sale-journal-applier', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Let the applier drain what it can, then stop it.
+
+        Entries still pending after the timeout stay in the journal file
+        and are replayed on the next start.
+        """
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            if self._reader:
+                self._reader.close()
+                self._reader = None
+
+    def _recover(self):
+        """
+        Load the checkpoint, re-queue unapplied entries and drop a torn
+        final line left by a crash in the middle of an append.
+        """
+        self._reader = self._connect()
+        cur = self._reader.cursor()
+        # In WAL mode readers never wait for a writer, so stock and
+        # idempotency lookups stay fast while the applier or a long
+        # report holds the database
+        cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sale_journal_state (
+              id INTEGER PRIMARY KEY CHECK (id = 1),
+              applied_seq INTEGER NOT NULL
+            )
+            """
+        )
+        cur.execute(
+            'INSERT OR IGNORE INTO sale_journal_state (id, applied_seq) '
+            'VALUES (1, 0)'
+        )
+        self._reader.commit()
+        cur.execute('SELECT applied_seq FROM sale_journal_state WHERE id = 1')
+        self.appliedSeq = int(cur.fetchone()['applied_seq'])
+        cur.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'total_transaction'"
+        )
+        row = cur.fetchone()
+        lastTransactionId = int(row['seq']) if row else 0
+
+        self._pending.clear()
+        self._pendingQty.clear()
+        self._pendingKeys.clear()
+        self._stock.clear()
+        lastSeq = self.appliedSeq
+
+        path = self.get_journal_path()
+        goodBytes = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for raw in f:
+                    try:
+                        entry = json.loads(raw)
+                    except ValueError:
+                        # Torn tail: this sale was never acknowledged
+                        break
+                    if not raw.endswith(b'\n'):
+                        break
+                    goodBytes += len(raw)
+                    lastSeq = max(lastSeq, entry['seq'])
+                    lastTransactionId = max(
+                        lastTransactionId, entry['transaction_id']
+                    )
+                    if entry['seq'] > self.appliedSeq:
+                        self._track(entry)
+
+        deadPath = self.get_dead_letter_path()
+        if os.path.exists(deadPath):
+            with open(deadPath, 'rb') as f:
+                self.deadLetters = sum(1 for _ in f)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'ab')
+        self._truncate(goodBytes)
+        self._nextSeq = lastSeq + 1
+        self._nextTransactionId = lastTransactionId + 1
+        if self._pending:
+            print(f'[INFO] Replaying {len(self._pending)} journaled sales')
+
+    def _track(self, entry):
+        self._pending.append(entry)
+        for line in entry['lines']:
+            pid = line['product_id']
+            self._pendingQty[pid] = \
+                self._pendingQty.get(pid, 0) + line['quantity']
+        if entry.get('request_key'):
+            self._pendingKeys[entry['request_key']] = (
+                entry['request_hash'], entry['result']
+            )
+
+    # -----------------------------
+    # Checkout side
+    # -----------------------------
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the journal lock while a checkout validates and appends.
+
+        Stock checks and the append happen under one lock, so two tills
+        can never both sell the last unit.
+        """
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError('sale journal is not running')
+            yield _JournalTransaction(self)
+
+    def _available_products(self, productIds):
+        """
+        Return cached product rows with quantity reduced by pending
+        sales, loading rows that are not cached yet.
+        """
+        missing = [pid for pid in productIds if pid not in self._stock]
+        if missing:
+            placeholders = ','.join(['?'] * len(missing))
+            # Read the checkpoint in the same statement so each row
+            # knows which journaled sales it already includes
+            cur = self._reader.execute(
+                f"""
+                SELECT product_id, name, price, quantity,
+                  (SELECT applied_seq FROM sale_journal_state
+                    WHERE id = 1) AS applied_seq
+                  FROM product
+                 WHERE product_id IN ({placeholders})
+                """,
+                missing,
+            )
+            for row in cur.fetchall():
+                self._stock[int(row['product_id'])] = dict(row)
+
+        products = {}
+        for pid in productIds:
+            row = self._stock.get(pid)
+            if row is None:
+                continue
+            if row['applied_seq'] > self.appliedSeq:
+                # Loaded just after the applier committed a batch it has
+                # not booked yet: only count sales newer than that batch
+                held = sum(
+                    line['quantity']
+                    for entry in self._pending
+                    if entry['seq'] > row['applied_seq']
+                    for line in entry['lines'] if line['product_id'] == pid
+                )
+            else:
+                held = self._pendingQty.get(pid, 0)
+            products[pid] = dict(row, quantity=int(row['quantity']) - held)
+        return products
+
+    def _append(self, entry):
+        entry['seq'] = self._nextSeq
+        data = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+        # Appends always land at the end of the file, whatever tell() says
+        start = os.fstat(self._file.fileno()).st_size
+        try:
+            self._file.write(data + b'\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError:
+            # Do not leave a partial line for later appends to follow
+            self._truncate(start)
+            raise
+        self._nextSeq += 1
+        self._track(entry)
+        self._wakeup.notify()
+
+    def _truncate(self, size):
+        """
+        Cut the journal file to size and move the file position with it.
+        """
+        self._file.truncate(size)
+        self._file.seek(size)
+
+    def invalidate(self, productId=None):
+        """
+        Forget a cached product row after it was edited directly, or
+        every cached row when productId is None.
+        """
+        with self._lock:
+            if productId is None:
+                self._stock.clear()
+            else:
+                self._stock.pop(productId, None)
+
+    @contextmanager
+    def stock_edit(self, productId):
+        """
+        Hold the journal lock while a product row is edited directly.
+
+        Yields the quantity that journaled, unapplied sales still take
+        from the product, so the edit can refuse to set the stock below
+        it. No sale can be journaled against the old row meanwhile, and
+        the cached row is dropped afterwards.
+        """
+        with self._lock:
+            try:
+                yield self._pendingQty.get(productId, 0)
+            finally:
+                self._stock.pop(productId, None)
+
+    # -----------------------------
+    # Applier side
+    # -----------------------------
+
+    def _run(self):
+        conn = None
+        delay = APPLY_RETRY_DELAY
+        # After a batch fails on a bad entry, that many entries are
+        # applied one at a time so only the bad one is set aside
+        singles = 0
+        while True:
+            with self._wakeup:
+                while not self._pending and not self._stopping:
+                    self._wakeup.wait()
+                if not self._pending:
+                    break
+                size = 1 if singles else self.batchSize
+                batch = list(islice(self._pending, size))
+
+            try:
+                if conn is None:
+                    conn = self._connect()
+                try:
+                    self._apply_batch(conn, batch)
+                except UNAPPLIABLE_ERRORS as e:
+                    conn.rollback()
+                    if len(batch) > 1:
+                        singles = len(batch)
+                        continue
+                    self._dead_letter(conn, batch[0], e)
+                singles = max(singles - 1, 0)
+                delay = APPLY_RETRY_DELAY
+            except (sqlite3.Error, OSError) as e:
+                if conn is not None:
+                    conn.rollback()
+                self.lastError = str(e)
+                print(f'[ERROR] Applying sale journal failed: {e}')
+                time.sleep(delay)
+                delay = min(delay * 2, APPLY_RETRY_MAX_DELAY)
+        if conn is not None:
+            conn.close()
+
+    def _apply_batch(self, conn, batch):
+        """
+        Write a batch of sales and the new checkpoint in one transaction.
+        """
+        from app.sales import store_checkout_result, write_sale
+
+        started = time.perf_counter()
+        cur = conn.cursor()
+        for entry in batch:
+            write_sale(cur, entry)
+            if entry.get('request_key'):
+                store_checkout_result(
+                    cur, entry['request_key'], entry['request_hash'],
+                    entry['result'],
+                )
+        lastSeq = batch[-1]['seq']
+        cur.execute(
+            'UPDATE sale_journal_state SET applied_seq = ? WHERE id = 1',
+            (lastSeq,),
+        )
+        conn.commit()
+
+        with self._lock:
+            self._book(batch, applied=True)
+            self.appliedTotal += len(batch)
+            self.lastBatchSize = len(batch)
+            self.lastApplyMs = round((time.perf_counter() - started) * 1000, 2)
+            self.lastError = None
+
+    def _dead_letter(self, conn, entry, error):
+        """
+        Move an entry the database refuses to the dead-letter file and
+        advance the checkpoint past it.
+
+        The entry is written out before the checkpoint moves, so a crash
+        in between can only record it twice, never lose it.
+        """
+        record = dict(entry, error=str(error), dead_lettered_at=time.time())
+        data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        with open(self.get_dead_letter_path(), 'ab') as f:
+            f.write(data + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        conn.execute(
+            'UPDATE sale_journal_state SET applied_seq = ? WHERE id = 1',
+            (entry['seq'],),
+        )
+        conn.commit()
+        print(
+            f"[ERROR] Sale journal entry {entry['seq']} moved to "
+            f"{self.get_dead_letter_path()}: {error}"
+        )
+
+        with self._lock:
+            self._book([entry], applied=False)
+            self.deadLetters += 1
+            self.lastDeadLetter = {
+                'seq': entry['seq'],
+                'transaction_id': entry.get('transaction_id'),
+                'error': str(error),
+            }
+
+    def _book(self, batch, applied):
+        """
+        Drop entries that left the journal from the pending state.
+
+        Cached stock rows only lose the sold quantity when the sale was
+        actually applied. Called with the journal lock held.
+        """
+        lastSeq = batch[-1]['seq']
+        for entry in batch:
+            self._pending.popleft()
+            if entry.get('request_key'):
+                self._pendingKeys.pop(entry['request_key'], None)
+            for line in entry['lines']:
+                pid = line['product_id']
+                self._pendingQty[pid] -= line['quantity']
+                if not self._pendingQty[pid]:
+                    del self._pendingQty[pid]
+                row = self._stock.get(pid)
+                if applied and row and row['applied_seq'] < entry['seq']:
+                    row['quantity'] -= line['quantity']
+        for row in self._stock.values():
+            row['applied_seq'] = max(row['applied_seq'], lastSeq)
+        self.appliedSeq = lastSeq
+
+        # Everything is in the database: start the file afresh
+        if not self._pending and self._file:
+            self._truncate(0)
+
+    # -----------------------------
+    # Metrics
+    # -----------------------------
+
+    def status(self):
+        """
+        Report applier lag and throughput.
+        """
+        with self._lock:
+            oldest = self._pending[0]['journaled_at'] if self._pending \
+                else None
+            return {
+                'running': self.is_running(),
+                'pending_entries': len(self._pending),
+                'applier_lag_seconds':
+                    round(time.time() - oldest, 3) if oldest else 0.0,
+                'applied_seq': self.appliedSeq,
+                'applied_total': self.appliedTotal,
+                'last_batch_size': self.lastBatchSize,
+                'last_apply_ms': self.lastApplyMs,
+                'last_error': self.lastError,
+                'dead_letters': self.deadLetters,
+                'last_dead_letter': self.lastDeadLetter,
+            }
+
+
+class _JournalTransaction:
+    """
+    Checkout's view of the journal while it holds the journal lock.
+    """
+
+    def __init__(self, journal):
+        self._journal = journal
+
+    @property
+    def cursor(self):
+        """Read-only cursor for lookups such as the idempotency table."""
+        return self._journal._reader.cursor()
+
+    def pending_result(self, requestKey):
+        """Return (request_hash, result) of a journaled, unapplied sale."""
+        return self._journal._pendingKeys.get(requestKey)
+
+    def products(self, productIds):
+        """
+        Return products with available quantity, in the same shape and
+        with the same error as sales.fetch_products.
+        """
+        prodById = self._journal._available_products(productIds)
+        missing = [pid for pid in productIds if pid not in prodById]
+        if missing:
+            return {}, {
+                'error': 'product_not_found',
+                'detail': f'missing product_ids: {missing}',
+            }
+        return prodById, None
+
+    def next_transaction_id(self):
+        transactionId = self._journal._nextTransactionId
+        self._journal._nextTransactionId += 1
+        return transactionId
+
+    def append(self, entry):
+        """Durably append a sale; it is safe once this returns."""
+        entry['journaled_at'] = time.time()
+        self._journal._append(entry)
+
+
+# One journal per store, created on first use
+_journals: Dict[str, SaleJournal] = {}
+_journalsLock = threading.Lock()
+
+
+def get_sale_journal(storeId=None):
+    """
+    Return the sale journal of a store (default: the current request's).
+    """
+    if storeId is None:
+        storeId = get_current_store()
+    with _journalsLock:
+        journal = _journals.get(storeId)
+        if journal is None:
+            journal = _journals[storeId] = SaleJournal(storeId)
+    return journal
+
+
+def start_sale_journals():
+    """
+    Recover and start the journal of every store.
+    """
+    for storeId in list_stores():
+        get_sale_journal(storeId).start()
+
+
+def stop_sale_journals():
+    """
+    Drain and stop every running journal.
+    """
+    with _journalsLock:
+        journals = list(_journals.values())
+    for journal in journals:
+        journal.stop()
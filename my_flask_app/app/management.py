@@ -6,17 +6,36 @@ Product CRUD logic and API endpoints as a Flask Blueprint.
 
 from flask import Blueprint, jsonify, request
 import sqlite3
-from app.helper import get_connection
+from app.helper import DEFAULT_STORE, get_connection, get_current_store
+from app.journal import get_sale_journal
+from app.stores import sync_catalog
 
 # -----------------------------
 # CRUD functions (with rollback)
 # -----------------------------
 
+def checkCatalogStore():
+    """
+    Raise ValueError unless the current store owns the product catalog.
+
+    Names, descriptions and prices are copied from the default store by
+    sync_catalog, which matches products by product_id, so a product
+    made or renamed in another store would be overwritten by the next
+    sync.
+    """
+    if get_current_store() != DEFAULT_STORE:
+        raise ValueError(
+            'Products are added and described in the default store; '
+            'other stores only change their stock'
+        )
+
+
 # Create a new product record in the database
 def createProduct(name, description, price, quantity):
     """
     Insert a new product into the product table with provided details.
     """
+    checkCatalogStore()
     conn = get_connection()
     cur = conn.cursor()
     try:
@@ -49,6 +68,8 @@ def modifyProduct(productId, name=None, description=None, price=None, quantity=N
     """
     Update the fields of an existing product identified by productId.
     """
+    if name is not None or description is not None or price is not None:
+        checkCatalogStore()
     conn = get_connection()
     cur = conn.cursor()
     try:
@@ -73,8 +94,16 @@ def modifyProduct(productId, name=None, description=None, price=None, quantity=N
 
         values.append(productId)
         sql = f"UPDATE product SET {', '.join(updates)} WHERE product_id = ?"
-        cur.execute(sql, values)
-        conn.commit()
+        # Sales journaled but not yet applied will still take their units
+        # off this row, so the new quantity must leave room for them
+        with get_sale_journal().stock_edit(productId) as held:
+            if quantity is not None and int(quantity) < held:
+                raise ValueError(
+                    f'Quantity cannot be below {held}: that many units are '
+                    'sold but not yet written to the database'
+                )
+            cur.execute(sql, values)
+            conn.commit()
 
         cur.execute('SELECT * FROM product WHERE product_id = ?', (productId,))
         row = cur.fetchone()
@@ -100,6 +129,7 @@ def deleteProduct(productId):
     try:
         cur.execute('DELETE FROM product WHERE product_id = ?', (productId,))
         conn.commit()
+        get_sale_journal().invalidate(productId)
         return cur.rowcount
     except Exception as e:
         conn.rollback()
@@ -161,6 +191,8 @@ def addProduct():
         return jsonify(product), 201
     except sqlite3.IntegrityError as e:
         return jsonify({'error': f'Integrity error: {e}'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -186,6 +218,8 @@ def updateProduct(productId):
         return jsonify(product), 200
     except sqlite3.IntegrityError as e:
         return jsonify({'error': f'Integrity error: {e}'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -202,3 +236,14 @@ def removeProduct(productId):
         return jsonify({'message': 'Product deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+
+@product_bp.route('/sync-catalog', methods=['POST'])
+def syncCatalog():
+    """
+    Endpoint to copy the default store's catalog to every other store.
+    """
+    try:
+        return jsonify(sync_catalog()), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
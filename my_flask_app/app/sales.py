@@ -7,11 +7,14 @@
 """
 
 from flask import Blueprint, request, jsonify, send_file
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from datetime import datetime
 from typing import DefaultDict, Dict, Iterable, List, Tuple
-from app.helper import get_connection
-import base64, io, time
+from app.helper import DEFAULT_STORE, get_connection, get_current_store, \
+  prune_checkout_requests
+from app.backup import record_checkout_latency
+from app.journal import get_sale_journal
+import base64, hashlib, hmac, io, itertools, json, os, sqlite3, sys, threading, time
 import qrcode
 
 # ======================================================================
@@ -100,44 +103,232 @@ def low_stock_warnings(prod_by_id: Dict[int, dict], combined: Dict[int, int], th
 # ======================================================================
 
 # Track QR payment status in memory for now
-# Structure: {transaction_id: {"status": "pending|paid|canceled|expired", "amount": float, "created": ts}}
-TX_STATUS: Dict[int, dict] = {}
+# Structure: {(store_id, transaction_id): {"status": "pending|paid|failed|canceled|expired", "amount": float, "created": ts}}
+TX_STATUS: Dict[Tuple[str, int], dict] = {}
 
-def _make_qr_png_b64(data: str) -> str:
-  """Return a base64 PNG for the provided payload string."""
+# QR rendering CPU time and webhook counters, reported by /qr-metrics
+QR_METRICS = {"renders": 0, "render_cpu_s": 0.0, "webhooks": 0, "webhook_duplicates": 0}
+_qr_metrics_lock = threading.Lock()
+
+# Gateway event ids already applied, oldest first, so redelivered
+# webhooks are acknowledged without being applied twice
+SEEN_WEBHOOK_EVENTS: "OrderedDict[str, None]" = OrderedDict()
+MAX_SEEN_WEBHOOK_EVENTS = 10000
+
+def _render_qr_png(data: str) -> bytes:
+  """Render a QR PNG for the payload, counting the CPU time it takes."""
+  started = time.thread_time()
   img = qrcode.make(data)
   buf = io.BytesIO()
   img.save(buf, format="PNG")
-  return base64.b64encode(buf.getvalue()).decode("ascii")
+  with _qr_metrics_lock:
+    QR_METRICS["renders"] += 1
+    QR_METRICS["render_cpu_s"] += time.thread_time() - started
+  return buf.getvalue()
+
+def _make_qr_png_b64(data: str) -> str:
+  """Return a base64 PNG for the provided payload string."""
+  return base64.b64encode(_render_qr_png(data)).decode("ascii")
 
-def _build_demo_qr_payload(txid: int, amount: float) -> str:
+def _build_demo_qr_payload(txid: int, amount: float, store_id: str = DEFAULT_STORE) -> str:
   """
   Replace this with a real EMVCo/PromptPay string later.
   For now, an opaque string unique per transaction is fine.
+  Transaction ids repeat across stores, so other stores add their id.
+  """
+  payload = f"PAYMENT|TX:{txid}|AMT:{amount:.2f}"
+  if store_id != DEFAULT_STORE:
+    payload += f"|STORE:{store_id}"
+  return payload
+
+def attach_qr_image(result: dict) -> dict:
+  """
+  Add the rendered QR PNG to a QR result. The PNG is never stored with
+  the sale, since it can always be re-rendered from qr_payload.
+  """
+  if result.get("qr_payload"):
+    result["qr_png_base64"] = _make_qr_png_b64(result["qr_payload"])
+  return result
+
+def register_qr_pending(result: dict) -> None:
+  """Mark a new QR transaction as 'pending' in memory (swap to DB later)."""
+  if result.get("payment_method") == "qr":
+    TX_STATUS[(get_current_store(), result["transaction_id"])] = {
+      "status": "pending",
+      "amount": result["total_amount"],
+      "created": time.time(),
+    }
+
+
+# ======================================================================
+# Idempotency Helpers
+# ======================================================================
+
+# Longest accepted client request key (UUIDs are 36 characters)
+MAX_REQUEST_KEY_LEN = 128
+
+# Old checkout results are pruned once per this many stored results
+CHECKOUT_REQUEST_PRUNE_EVERY = 500
+
+def request_fingerprint(items: List[dict], payment_method: str) -> str:
+  """Hash the raw request so a reused key with a different cart is caught."""
+  raw = json.dumps([items, payment_method], sort_keys=True, default=str)
+  return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def replay_checkout_result(stored_hash: str, result: dict, request_hash: str) -> dict:
+  """Return a stored result for a retry, or an error if the cart differs."""
+  if stored_hash != request_hash:
+    return {
+      "error": "idempotency_key_reused",
+      "detail": "request key was already used for a different checkout",
+    }
+  return attach_qr_image(dict(result, idempotent_replay=True))
+
+
+def find_checkout_result(cur, request_key: str, request_hash: str) -> dict | None:
+  """
+  Return the stored result for request_key, or None if it is new.
+  This is a single primary-key lookup; nothing is re-validated.
   """
-  return f"PAYMENT|TX:{txid}|AMT:{amount:.2f}"
+  cur.execute(
+    "SELECT request_hash, response FROM checkout_request WHERE request_key = ?",
+    (request_key,),
+  )
+  row = cur.fetchone()
+  if row is None:
+    return None
+  return replay_checkout_result(
+    row["request_hash"], json.loads(row["response"]), request_hash
+  )
+
+
+_checkout_results_stored = itertools.count(1)
+
+def store_checkout_result(cur, request_key: str, request_hash: str, result: dict) -> None:
+  cur.execute(
+    """
+    INSERT INTO checkout_request
+      (request_key, request_hash, transaction_id, response, created_at)
+    VALUES (?, ?, ?, ?, ?)
+    """,
+    (
+      request_key,
+      request_hash,
+      result["transaction_id"],
+      json.dumps(result),
+      result["timestamp"],
+    ),
+  )
+  if next(_checkout_results_stored) % CHECKOUT_REQUEST_PRUNE_EVERY == 0:
+    prune_checkout_requests(cur)
 
 
 # ======================================================================
 # Core Sales Logic
 # ======================================================================
 
-def sell_products(items: List[dict], payment_method: str = "cash", low_stock_threshold: int = 5) -> dict:
+def build_sale_result(
+  transaction_id: int,
+  line_summaries: List[dict],
+  total_amount: float,
+  payment_method: str,
+  now_str: str,
+  warnings: List[str],
+) -> dict:
+  """Build the checkout response (without the QR PNG, see attach_qr_image)."""
+  result = {
+    "transaction_id": transaction_id,
+    "items": line_summaries,
+    "total_amount": float(total_amount),
+    "payment_method": payment_method,
+    "timestamp": now_str,
+  }
+  if warnings:
+    result["warnings"] = warnings
+
+  # === Attach QR data when payment method is QR ===
+  if payment_method == "qr":
+    result["qr_payload"] = _build_demo_qr_payload(
+      transaction_id, float(total_amount), get_current_store()
+    )
+    result["expires_in"] = 300  # 5 minutes
+  return result
+
+
+def write_sale(cur, sale: dict) -> int:
+  """
+  Record a sale: header, lines and inventory update.
+  sale: {transaction_id (None to auto-assign), timestamp, total_amount,
+         payment_method, lines: [{product_id, name, unit_price, quantity}]}
+  Used by sell_products and by the sale journal applier.
+  """
+  # Insert transaction header
+  cur.execute(
+    """
+    INSERT INTO total_transaction
+      (transaction_id, total_amount, date_and_time, payment_method)
+    VALUES (?, ?, ?, ?)
+    """,
+    (sale.get("transaction_id"), sale["total_amount"], sale["timestamp"],
+     sale["payment_method"]),
+  )
+  transaction_id = cur.lastrowid
+
+  # Insert transaction lines
+  for line in sale["lines"]:
+    cur.execute(
+      """
+      INSERT INTO each_transaction (name, transaction_id, price, quantity)
+      VALUES (?, ?, ?, ?)
+      """,
+      (line["name"], transaction_id, line["unit_price"], line["quantity"]),
+    )
+
+  # Update inventory (note: for real QR flow you may want to defer stock update until 'paid')
+  for line in sale["lines"]:
+    cur.execute(
+      """
+      UPDATE product
+      SET quantity = quantity - ?, total_sales = total_sales + ?
+      WHERE product_id = ?
+      """,
+      (line["quantity"], line["quantity"], line["product_id"]),
+    )
+  return transaction_id
+
+
+def sell_products(
+  items: List[dict],
+  payment_method: str = "cash",
+  low_stock_threshold: int = 5,
+  request_key: str | None = None,
+) -> dict:
   """
   Sell multiple products in a single transaction.
   items: list of {product_id, quantity}
   payment_method: 'cash' | 'credit' | 'qr' | 'wallet'
+  request_key: optional client idempotency key; a retry with the same
+    key returns the stored result instead of selling again
   """
-  combined, err = combine_items(items)
-  if err:
-    return err
-
-  product_ids = list(combined.keys())
+  started = time.perf_counter()
   conn = get_connection()
 
   try:
     cur = conn.cursor()
 
+    # Replay a previously completed checkout before doing any work
+    if request_key:
+      request_hash = request_fingerprint(items, payment_method)
+      stored = find_checkout_result(cur, request_key, request_hash)
+      if stored:
+        return stored
+
+    combined, err = combine_items(items)
+    if err:
+      return err
+
+    product_ids = list(combined.keys())
     prod_by_id, err = fetch_products(cur, product_ids)
     if err:
       return err
@@ -148,72 +339,105 @@ def sell_products(items: List[dict], payment_method: str = "cash", low_stock_thr
 
     line_summaries, total_amount = calc_lines_and_total(prod_by_id, combined)
     now_str = datetime.now().isoformat(timespec="seconds")
+    transaction_id = write_sale(cur, {
+      "transaction_id": None,
+      "timestamp": now_str,
+      "total_amount": total_amount,
+      "payment_method": payment_method,
+      "lines": line_summaries,
+    })
 
-    # Insert transaction header
-    cur.execute(
-      """
-      INSERT INTO total_transaction (total_amount, date_and_time, payment_method)
-      VALUES (?, ?, ?)
-      """,
-      (total_amount, now_str, payment_method),
+    warnings = low_stock_warnings(prod_by_id, combined, low_stock_threshold)
+    result = build_sale_result(
+      transaction_id, line_summaries, total_amount, payment_method, now_str, warnings
     )
-    transaction_id = cur.lastrowid
-
-    # Insert transaction lines
-    for line in line_summaries:
-      cur.execute(
-        """
-        INSERT INTO each_transaction (name, transaction_id, price, quantity)
-        VALUES (?, ?, ?, ?)
-        """,
-        (line["name"], transaction_id, line["unit_price"], line["quantity"]),
-      )
 
-    # Update inventory (note: for real QR flow you may want to defer stock update until 'paid')
-    for pid, qty in combined.items():
-      cur.execute(
-        """
-        UPDATE product
-        SET quantity = quantity - ?, total_sales = total_sales + ?
-        WHERE product_id = ?
-        """,
-        (qty, qty, pid),
-      )
+    # Store the result in the same transaction as the sale itself, so a
+    # key is recorded if and only if the sale is
+    if request_key:
+      store_checkout_result(cur, request_key, request_hash, result)
 
     conn.commit()
 
-    warnings = low_stock_warnings(prod_by_id, combined, low_stock_threshold)
-    result = {
-      "transaction_id": transaction_id,
-      "items": line_summaries,
-      "total_amount": float(total_amount),
-      "payment_method": payment_method,
-      "timestamp": now_str,
-    }
-    if warnings:
-      result["warnings"] = warnings
-
-    # === Attach QR data when payment method is QR ===
-    if payment_method == "qr":
-      # Mark this transaction as 'pending' in memory (swap to DB later)
-      TX_STATUS[transaction_id] = {
-        "status": "pending",
-        "amount": float(total_amount),
-        "created": time.time(),
-      }
-      # Build a payload and PNG QR for the frontend
-      payload = _build_demo_qr_payload(transaction_id, float(total_amount))
-      result["qr_payload"] = payload
-      result["qr_png_base64"] = _make_qr_png_b64(payload)
-      result["expires_in"] = 300  # 5 minutes
-
-    return result
+    register_qr_pending(result)
+    return attach_qr_image(result)
 
+  except sqlite3.IntegrityError:
+    # A concurrent retry with the same key committed first; return its result
+    conn.rollback()
+    if not request_key:
+      raise
+    stored = find_checkout_result(conn.cursor(), request_key, request_hash)
+    return stored or {"error": "db_error", "detail": "checkout conflict"}
   except (RuntimeError, ValueError, OSError) as exc:
     conn.rollback()
     return {"error": "db_error", "detail": str(exc)}
   finally:
     conn.close()
+    record_checkout_latency(time.perf_counter() - started)
+
+
+def sell_products_journaled(
+  items: List[dict],
+  payment_method: str = "cash",
+  low_stock_threshold: int = 5,
+  request_key: str | None = None,
+) -> dict:
+  """
+  Sell like sell_products, but return once the sale is in the journal.
+  Stock is checked against the journal's cached stock view, and the
+  applier thread writes the sale to the database shortly afterwards.
+  """
+  started = time.perf_counter()
+  try:
+    with get_sale_journal().transaction() as jtx:
+      # Replay a checkout that is still in the journal or already applied
+      if request_key:
+        request_hash = request_fingerprint(items, payment_method)
+        pending = jtx.pending_result(request_key)
+        if pending:
+          return replay_checkout_result(pending[0], pending[1], request_hash)
+        stored = find_checkout_result(jtx.cursor, request_key, request_hash)
+        if stored:
+          return stored
+
+      combined, err = combine_items(items)
+      if err:
+        return err
+
+      prod_by_id, err = jtx.products(list(combined.keys()))
+      if err:
+        return err
+
+      err = check_stock(prod_by_id, combined)
+      if err:
+        return err
+
+      line_summaries, total_amount = calc_lines_and_total(prod_by_id, combined)
+      now_str = datetime.now().isoformat(timespec="seconds")
+      transaction_id = jtx.next_transaction_id()
+      warnings = low_stock_warnings(prod_by_id, combined, low_stock_threshold)
+      result = build_sale_result(
+        transaction_id, line_summaries, total_amount, payment_method, now_str, warnings
+      )
+      jtx.append({
+        "transaction_id": transaction_id,
+        "timestamp": now_str,
+        "total_amount": total_amount,
+        "payment_method": payment_method,
+        "lines": line_summaries,
+        "request_key": request_key,
+        "request_hash": request_hash if request_key else None,
+        "result": result,
+      })
+
+    register_qr_pending(result)
+    return attach_qr_image(dict(result))
+
+  except (sqlite3.Error, RuntimeError, OSError) as exc:
+    return {"error": "db_error", "detail": str(exc)}
+  finally:
+    record_checkout_latency(time.perf_counter() - started)
 
 
 # ======================================================================
@@ -227,7 +451,10 @@ def checkout_sale():
   """
   Process a checkout transaction with a specified payment method.
   Request JSON:
-    { "items": [...], "payment_method": "cash"|"credit"|"qr"|"wallet" }
+    { "items": [...], "payment_method": "cash"|"credit"|"qr"|"wallet",
+      "request_key": "<optional client idempotency key>" }
+  The key may also be sent as an Idempotency-Key header; retries with the
+  same key return the original result instead of selling again.
   """
   data = request.get_json(force=True)
   if not data or "items" not in data:
@@ -241,13 +468,31 @@ def checkout_sale():
       "detail": f"Use one of: {sorted(allowed)}"
     }), 400
 
-  result = sell_products(data["items"], payment_method)
+  request_key = request.headers.get("Idempotency-Key") or data.get("request_key")
+  if request_key is not None:
+    request_key = str(request_key).strip()
+    if not request_key or len(request_key) > MAX_REQUEST_KEY_LEN:
+      return jsonify({
+        "error": "invalid_request_key",
+        "detail": f"request key must be 1-{MAX_REQUEST_KEY_LEN} characters"
+      }), 400
+
+  sell = sell_products_journaled if get_sale_journal().is_running() else sell_products
+  result = sell(data["items"], payment_method, request_key=request_key)
   if "error" in result:
     return jsonify(result), 400
 
   return jsonify(result), 200
 
 
+@sales_bp.get("/journal-status")
+def journal_status():
+  """
+  Report sale journal applier lag (pending sales, age of the oldest).
+  """
+  return jsonify(get_sale_journal().status()), 200
+
+
 @sales_bp.get("/product/<int:product_id>")
 def get_product(product_id: int):
   conn = get_connection()
@@ -323,7 +568,7 @@ def qr_status(transaction_id: int):
   Poll current status of a QR transaction.
   Auto-expires after 5 minutes if still pending.
   """
-  tx = TX_STATUS.get(transaction_id)
+  tx = TX_STATUS.get((get_current_store(), transaction_id))
   if not tx:
     # If not in memory, treat as unknown (or consult DB if you add a status column there).
     return jsonify({"status": "unknown"}), 200
@@ -339,16 +584,111 @@ def qr_mark_paid(transaction_id: int):
   """
   Manual test endpoint: mark a QR transaction as paid.
   In production, this would be triggered by your payment gateway webhook.
+  Like an unsigned webhook it would let anyone mark a sale paid, so it
+  is refused unless SMARTVISION_ALLOW_MARK_PAID=1 (for development).
   """
-  tx = TX_STATUS.get(transaction_id)
+  if os.environ.get("SMARTVISION_ALLOW_MARK_PAID") != "1":
+    return jsonify({
+      "error": "mark_paid_disabled",
+      "detail": "SMARTVISION_ALLOW_MARK_PAID is not set",
+    }), 403
+  key = (get_current_store(), transaction_id)
+  tx = TX_STATUS.get(key)
   if not tx:
     # If it's not tracked in memory, you might verify via DB instead.
-    TX_STATUS[transaction_id] = {"status": "paid", "amount": 0.0, "created": time.time()}
+    TX_STATUS[key] = {"status": "paid", "amount": 0.0, "created": time.time()}
   else:
     tx["status"] = "paid"
   return jsonify({"ok": True}), 200
 
 
+@sales_bp.post("/payment-webhook")
+def payment_webhook():
+  """
+  Payment gateway callback for a QR transaction.
+  Request JSON:
+    { "event_id": str, "transaction_id": int, "status": "paid"|"failed", "amount": float }
+  Gateways retry and may deliver an event twice, so a repeated event_id
+  is acknowledged without being applied again. X-Signature must be the
+  hex HMAC-SHA256 of the request body under SMARTVISION_WEBHOOK_SECRET;
+  without a secret every webhook is refused, since anyone could mark a
+  sale paid.
+  """
+  secret = os.environ.get("SMARTVISION_WEBHOOK_SECRET")
+  if not secret:
+    return jsonify({
+      "error": "webhook_disabled",
+      "detail": "SMARTVISION_WEBHOOK_SECRET is not set",
+    }), 403
+  expected = hmac.new(secret.encode("utf-8"), request.get_data(), hashlib.sha256).hexdigest()
+  if not hmac.compare_digest(expected, request.headers.get("X-Signature", "")):
+    return jsonify({"error": "bad_signature"}), 401
+
+  data = request.get_json(silent=True) or {}
+  try:
+    event_id = str(data["event_id"])
+    transaction_id = int(data["transaction_id"])
+    status = data["status"]
+    amount = float(data.get("amount", 0))
+  except (KeyError, ValueError, TypeError):
+    return jsonify({"error": "invalid_event", "detail": "Bad webhook format"}), 400
+  if status not in ("paid", "failed"):
+    return jsonify({"error": "invalid_status", "detail": "Use 'paid' or 'failed'"}), 400
+
+  store_id = get_current_store()
+  # Check, apply and record the event under one lock, so two deliveries
+  # of the same event arriving together cannot both be applied. A
+  # rejected event is not recorded, so the gateway's retry still counts.
+  with _qr_metrics_lock:
+    QR_METRICS["webhooks"] += 1
+    if event_id in SEEN_WEBHOOK_EVENTS:
+      QR_METRICS["webhook_duplicates"] += 1
+      return jsonify({"ok": True, "duplicate": True}), 200
+
+    tx = TX_STATUS.get((store_id, transaction_id))
+    if not tx:
+      return jsonify({"error": "not_found", "detail": "Unknown QR transaction"}), 404
+    if status == "paid" and abs(amount - tx["amount"]) > 0.005:
+      return jsonify({"error": "amount_mismatch", "detail": f"expected {tx['amount']:.2f}"}), 400
+
+    if tx["status"] == "pending":
+      tx["status"] = status
+
+    SEEN_WEBHOOK_EVENTS[event_id] = None
+    if len(SEEN_WEBHOOK_EVENTS) > MAX_SEEN_WEBHOOK_EVENTS:
+      SEEN_WEBHOOK_EVENTS.popitem(last=False)
+    return jsonify({"ok": True, "status": tx["status"]}), 200
+
+
+@sales_bp.get("/qr-metrics")
+def qr_metrics():
+  """
+  Report CPU time spent rendering QR images, webhook counts and the
+  size of the in-memory payment state (for the QR load harness).
+  """
+  with _qr_metrics_lock:
+    metrics = dict(QR_METRICS)
+    seen_events = len(SEEN_WEBHOOK_EVENTS)
+  entries = list(TX_STATUS.items())
+  # Rough footprint: the dict itself plus each key and status record
+  state_bytes = sys.getsizeof(TX_STATUS) + sum(
+    sys.getsizeof(key) + sys.getsizeof(tx) + sum(sys.getsizeof(v) for v in tx.values())
+    for key, tx in entries
+  )
+  renders = metrics["renders"]
+  return jsonify({
+    "qr_renders": renders,
+    "qr_render_cpu_ms_total": round(metrics["render_cpu_s"] * 1000, 2),
+    "qr_render_cpu_ms_avg": round(metrics["render_cpu_s"] * 1000 / renders, 3) if renders else 0.0,
+    "webhooks_received": metrics["webhooks"],
+    "webhook_duplicates": metrics["webhook_duplicates"],
+    "seen_webhook_events": seen_events,
+    "tx_status_entries": len(entries),
+    "tx_status_by_status": dict(Counter(tx["status"] for _, tx in entries)),
+    "tx_status_bytes": state_bytes,
+  }), 200
+
+
 @sales_bp.get("/qr.png")
 def qr_png():
   """
@@ -358,8 +698,5 @@ def qr_png():
   data = (request.args.get("data") or "").strip()
   if not data:
     return jsonify({"error": "no_data"}), 400
-  img = qrcode.make(data)
-  buf = io.BytesIO()
-  img.save(buf, format="PNG")
-  buf.seek(0)
+  buf = io.BytesIO(_render_qr_png(data))
   return send_file(buf, mimetype="image/png")
@@ -4,39 +4,80 @@ from app.helper import get_connection
 sales_report_bp = Blueprint('sales_report', __name__, url_prefix='/sales-report')
 
 
+# SQL grouping expression for each report grouping
+GROUP_EXPRESSIONS = {
+    'daily': "date(tt.date_and_time)",
+    'weekly': "strftime('%Y-W%W', tt.date_and_time)",
+    'monthly': "strftime('%Y-%m', tt.date_and_time)",
+}
+
+
+def build_sales_report_sql(start_date=None, end_date=None, group_by='daily'):
+    """Return the revenue/quantity report query and its parameters.
+
+    group_key names the day, week or month of each row, so rows from
+    several stores can be merged.
+    """
+    groupExpr = GROUP_EXPRESSIONS.get(group_by)
+    sql = f"""
+    SELECT 
+        date(tt.date_and_time) AS period,
+        {groupExpr or "'all'"} AS group_key,
+        SUM(et.quantity * et.price) AS total_amount,
+        SUM(et.quantity) AS total_quantity
+    FROM each_transaction et
+    JOIN total_transaction tt ON et.transaction_id = tt.transaction_id
+    WHERE 1=1
+    """
+    params = []
+
+    # Date filters
+    if start_date:
+        sql += " AND date(tt.date_and_time) >= date(?)"
+        params.append(start_date)
+    if end_date:
+        sql += " AND date(tt.date_and_time) <= date(?)"
+        params.append(end_date)
+
+    # Grouping
+    if groupExpr:
+        sql += f" GROUP BY {groupExpr} ORDER BY {groupExpr} ASC"
+    return sql, params
+
+
+def build_transactions_sql(start_date=None, end_date=None):
+    """Return the per-product transactions query and its parameters."""
+    sql = """
+        SELECT 
+            date(tt.date_and_time) AS period,
+            et.name,
+            SUM(et.quantity) AS total_quantity,
+            et.price,
+            SUM(et.quantity * et.price) AS subtotal
+        FROM total_transaction tt
+        JOIN each_transaction et ON tt.transaction_id = et.transaction_id
+        WHERE 1=1
+    """
+    params = []
+
+    if start_date:
+        sql += " AND date(tt.date_and_time) >= date(?)"
+        params.append(start_date)
+    if end_date:
+        sql += " AND date(tt.date_and_time) <= date(?)"
+        params.append(end_date)
+
+    sql += " GROUP BY period, et.name, et.price ORDER BY period ASC"
+    return sql, params
+
+
 def query_sales_report(start_date=None, end_date=None, group_by='daily'):
     """Return total revenue and quantity sold per period (day/week/month)."""
     try:
         conn = get_connection()
         cur = conn.cursor()
 
-        sql = """
-        SELECT 
-            date(tt.date_and_time) AS period,
-            SUM(et.quantity * et.price) AS total_amount,
-            SUM(et.quantity) AS total_quantity
-        FROM each_transaction et
-        JOIN total_transaction tt ON et.transaction_id = tt.transaction_id
-        WHERE 1=1
-        """
-        params = []
-
-        # Date filters
-        if start_date:
-            sql += " AND date(tt.date_and_time) >= date(?)"
-            params.append(start_date)
-        if end_date:
-            sql += " AND date(tt.date_and_time) <= date(?)"
-            params.append(end_date)
-
-        # Grouping
-        if group_by == 'daily':
-            sql += " GROUP BY date(tt.date_and_time) ORDER BY date(tt.date_and_time) ASC"
-        elif group_by == 'weekly':
-            sql += " GROUP BY strftime('%Y-W%W', tt.date_and_time) ORDER BY strftime('%Y-W%W', tt.date_and_time) ASC"
-        elif group_by == 'monthly':
-            sql += " GROUP BY strftime('%Y-%m', tt.date_and_time) ORDER BY strftime('%Y-%m', tt.date_and_time) ASC"
-
+        sql, params = build_sales_report_sql(start_date, end_date, group_by)
         cur.execute(sql, params)
         rows = cur.fetchall()
         conn.close()
@@ -72,27 +113,7 @@ def transactions_json():
     conn = get_connection()
     cur = conn.cursor()
 
-    sql = """
-        SELECT 
-            date(tt.date_and_time) AS period,
-            et.name,
-            SUM(et.quantity) AS total_quantity,
-            et.price,
-            SUM(et.quantity * et.price) AS subtotal
-        FROM total_transaction tt
-        JOIN each_transaction et ON tt.transaction_id = et.transaction_id
-        WHERE 1=1
-    """
-    params = []
-
-    if start_date:
-        sql += " AND date(tt.date_and_time) >= date(?)"
-        params.append(start_date)
-    if end_date:
-        sql += " AND date(tt.date_and_time) <= date(?)"
-        params.append(end_date)
-
-    sql += " GROUP BY period, et.name, et.price ORDER BY period ASC"
+    sql, params = build_transactions_sql(start_date, end_date)
 
     cur.execute(sql, params)
     rows = cur.fetchall()
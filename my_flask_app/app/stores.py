@@ -0,0 +1,124 @@
+"""
+stores.py
+
+Store shards for shops that run more than one store.
+
+Each store keeps its own stock and sales in its own database file. The
+default store's product table is the shared catalog: syncing copies
+product names, descriptions and prices to every other store while each
+store keeps its own quantity and total_sales. Products are only created
+and described in the default store (see management.checkCatalogStore),
+so product ids never collide between stores.
+
+Command line usage (run from the my_flask_app folder):
+    python -m app.stores list
+    python -m app.stores create <store_id>
+    python -m app.stores sync
+"""
+
+import os
+import sqlite3
+import sys
+
+from app.helper import DEFAULT_STORE, STORE_ID_PATTERN, connect_db, \
+    get_base_dir, get_db_path, get_stores_dir, list_stores
+from app.journal import get_sale_journal
+
+
+def create_store(storeId):
+    """
+    Create an empty database for a new store and fill its catalog.
+    """
+    if not STORE_ID_PATTERN.match(storeId) or storeId == DEFAULT_STORE:
+        raise ValueError(f'Invalid store id: {storeId!r}')
+    dbPath = get_db_path(storeId)
+    if os.path.exists(dbPath):
+        raise ValueError(f'Store already exists: {storeId}')
+
+    schemaPath = os.path.join(get_base_dir(), 'database', 'database.sql')
+    with open(schemaPath, encoding='utf-8') as f:
+        schema = f.read()
+
+    os.makedirs(get_stores_dir(), exist_ok=True)
+    conn = sqlite3.connect(dbPath)
+    try:
+        conn.executescript(schema)
+        conn.commit()
+    except sqlite3.Error:
+        conn.close()
+        os.remove(dbPath)
+        raise
+    conn.close()
+    return sync_catalog(targets=[storeId])
+
+
+def sync_catalog(source=DEFAULT_STORE, targets=None):
+    """
+    Copy product details from the source store to the target stores.
+
+    New products are added with quantity 0; existing products get the
+    source name, description and price. Stock and sales are per store
+    and are never touched. Returns how many products each store added
+    and updated.
+    """
+    conn = connect_db(get_db_path(source))
+    try:
+        catalog = [
+            tuple(row) for row in conn.execute(
+                'SELECT product_id, name, description, price FROM product'
+            )
+        ]
+    finally:
+        conn.close()
+
+    if targets is None:
+        targets = [s for s in list_stores() if s != source]
+
+    summary = {}
+    for storeId in targets:
+        conn = connect_db(get_db_path(storeId))
+        try:
+            cur = conn.cursor()
+            cur.executemany(
+                'INSERT OR IGNORE INTO product '
+                '(product_id, name, description, price, quantity) '
+                'VALUES (?, ?, ?, ?, 0)',
+                catalog,
+            )
+            added = cur.rowcount
+            cur.executemany(
+                'UPDATE product SET name = ?, description = ?, price = ? '
+                'WHERE product_id = ?',
+                [(name, desc, price, pid) for pid, name, desc, price in catalog],
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        # Prices may have changed under the checkout stock view
+        get_sale_journal(storeId).invalidate()
+        summary[storeId] = {'added': added, 'synced': len(catalog)}
+    return summary
+
+
+def main(argv):
+    """
+    Run a list, create or sync command from the command line.
+    """
+    if argv == ['list']:
+        for storeId in list_stores():
+            print(storeId)
+    elif len(argv) == 2 and argv[0] == 'create':
+        print(create_store(argv[1]))
+    elif argv == ['sync']:
+        print(sync_catalog())
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
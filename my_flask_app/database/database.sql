@@ -28,3 +28,15 @@ create table each_transaction
   quantity integer not null default 1 check(quantity > 0),
   foreign key (transaction_id) references total_transaction(transaction_id)
 );
+
+-- Table remembering the result of each client checkout request key, so a
+-- retried checkout returns the original sale instead of selling twice
+create table checkout_request
+(
+  request_key text primary key,
+  request_hash text not null,
+  transaction_id integer not null,
+  response text not null,
+  created_at datetime not null,
+  foreign key (transaction_id) references total_transaction(transaction_id)
+);
@@ -1,8 +1,12 @@
-from flask import Flask, render_template
+from flask import Flask, jsonify, render_template
 from app.management import product_bp 
 from app.sales import sales_bp
 from app.sales_report import sales_report_bp
-import os,sys
+from app.backup import backup_bp, start_backup_schedules, SNAPSHOT_INTERVAL
+from app.journal import start_sale_journals, stop_sale_journals
+from app.federation import chain_report_bp
+from app.helper import get_current_store
+import atexit, multiprocessing, os, sys
 
 if getattr(sys, "frozen", False):
     # Running as PyInstaller exe
@@ -20,6 +24,17 @@ DB_PATH = os.path.join(BASE_DIR, "database", "mydatabase.db")
 app.register_blueprint(product_bp)
 app.register_blueprint(sales_bp)
 app.register_blueprint(sales_report_bp)
+app.register_blueprint(backup_bp)
+app.register_blueprint(chain_report_bp)
+
+@app.before_request
+def check_store():
+    # Reject unknown store ids before any handler opens a database
+    try:
+        get_current_store()
+    except ValueError as e:
+        return jsonify({"error": "invalid_store", "detail": str(e)}), 400
+
 # Frontend routes
 @app.route("/product-management.html")
 def product_page():
@@ -38,4 +53,18 @@ def sales_report_page():
     return render_template("sales-report.html")
 
 if __name__ == "__main__":
+    # Needed for the report process pool in a PyInstaller build
+    multiprocessing.freeze_support()
+    # Scheduled snapshots; set SMARTVISION_BACKUP_INTERVAL=0 to disable
+    interval = int(os.environ.get("SMARTVISION_BACKUP_INTERVAL", SNAPSHOT_INTERVAL))
+    if interval > 0:
+        start_backup_schedules(interval)
+    # Sale journal in front of the database; SMARTVISION_SALE_JOURNAL=0 disables
+    if os.environ.get("SMARTVISION_SALE_JOURNAL", "1") != "0":
+        start_sale_journals()
+        atexit.register(stop_sale_journals)
+    # Payment webhooks are refused unless they can be verified
+    if not os.environ.get("SMARTVISION_WEBHOOK_SECRET"):
+        print("[WARNING] SMARTVISION_WEBHOOK_SECRET is not set: "
+              "/api/sales/payment-webhook will refuse every QR payment callback")
     app.run(debug=False)
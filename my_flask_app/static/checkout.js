@@ -49,9 +49,12 @@ if (codeOrNameInput && !suggestionBox) {
 let cart = [];
 let activeIndex = -1;
 let currentData = [];
+let checkoutKey = null; // idempotency key for the cart being paid
 
 /* =============================== Constants ============================= */
 const API_SALES = "http://127.0.0.1:5000/api/sales";
+const CHECKOUT_TIMEOUT_MS = 8000;
+const CHECKOUT_RETRIES = 4;
 
 /* ============================ QR Helpers ============================== */
 let pollTimer = null;
@@ -95,8 +98,8 @@ async function pollPayment(transactionId) {
         cart = [];
         renderCart();
         alert("✅ Sale complete! Payment received.");
-      } else if (status === "expired" || status === "canceled") {
-        if (statusEl) statusEl.textContent = "❌ Payment expired/canceled";
+      } else if (status === "expired" || status === "canceled" || status === "failed") {
+        if (statusEl) statusEl.textContent = "❌ Payment expired/canceled/failed";
         clearInterval(pollTimer); pollTimer = null;
       }
     } catch (_) {
@@ -126,17 +129,55 @@ async function fetchProduct(productId) {
   return data;
 }
 
+// Create a unique key for one checkout attempt
+function newCheckoutKey() {
+  if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+  return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Send the checkout, retrying timeouts and network errors with the same
+// idempotency key so the server never records the sale twice
 async function processCheckout(items, paymentMethod = "cash") {
-  const res = await fetch(`${API_SALES}/checkout`, {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ items, payment_method: paymentMethod }),
-  });
-  const data = await res.json();
-  if (!res.ok || data.error) {
-    throw new Error(data.detail || data.error || "Checkout failed");
+  if (!checkoutKey) checkoutKey = newCheckoutKey();
+  let lastError = null;
+
+  for (let attempt = 0; attempt <= CHECKOUT_RETRIES; attempt++) {
+    if (attempt > 0) {
+      await new Promise((r) => setTimeout(r, 250 * 2 ** (attempt - 1)));
+    }
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), CHECKOUT_TIMEOUT_MS);
+    let res;
+    try {
+      res = await fetch(`${API_SALES}/checkout`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          "Idempotency-Key": checkoutKey,
+        },
+        body: JSON.stringify({ items, payment_method: paymentMethod }),
+        signal: controller.signal,
+      });
+    } catch (err) {
+      lastError = err;
+      continue;
+    } finally {
+      clearTimeout(timer);
+    }
+    if (res.status >= 500) {
+      lastError = new Error(`Server error ${res.status}`);
+      continue;
+    }
+
+    const data = await res.json();
+    // The server answered, so the next checkout needs a fresh key
+    checkoutKey = null;
+    if (!res.ok || data.error) {
+      throw new Error(data.detail || data.error || "Checkout failed");
+    }
+    return data;
   }
-  return data;
+  throw new Error(lastError ? lastError.message : "Checkout failed");
 }
 
 /* ============================ Autocomplete ============================= */
@@ -275,6 +316,7 @@ function computeTotal() {
 
 /* ============================== Rendering ============================== */
 function renderCart() {
+  checkoutKey = null; // cart changed, so it is a different checkout
   tbody.innerHTML = "";
   const total = computeTotal();
 
@@ -433,7 +475,12 @@ if (btnQrPaid) {
     const tx = btnQrPaid.dataset.txid;
     if (!tx) return closeQrModal();
     try {
-      await fetch(`${API_SALES}/mark-paid/${tx}`, { method: "POST" });
+      const res = await fetch(`${API_SALES}/mark-paid/${tx}`, { method: "POST" });
+      // Refused outside development: payment is confirmed by the gateway
+      if (!res.ok) {
+        const data = await res.json().catch(() => ({}));
+        alert("❌ " + (data.detail || "Payment can only be confirmed by the gateway."));
+      }
       // The poller will see "paid" shortly, or you could force-close here.
     } catch (_) {}
   });
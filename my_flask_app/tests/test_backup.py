@@ -0,0 +1,116 @@
+"""
+Checks for the online backup in app/backup.py.
+
+Run from the my_flask_app folder:
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from app.backup import METRICS, online_backup
+
+
+class OnlineBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # A rollback-journal database, as a shop without the sale
+        # journal has
+        self.dbPath = os.path.join(self.tmp.name, 'live.db')
+        self.targetPath = os.path.join(self.tmp.name, 'snapshot.db')
+        conn = sqlite3.connect(self.dbPath)
+        conn.execute('CREATE TABLE sale (id INTEGER PRIMARY KEY, data BLOB)')
+        conn.executemany(
+            'INSERT INTO sale (data) VALUES (?)',
+            [(os.urandom(1024),) for _ in range(2000)],
+        )
+        conn.commit()
+        conn.close()
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        self.tmp.cleanup()
+
+    def start_writer(self):
+        def writer():
+            conn = sqlite3.connect(self.dbPath, timeout=30)
+            while not self.stop.is_set():
+                conn.execute(
+                    'INSERT INTO sale (data) VALUES (?)', (os.urandom(64),)
+                )
+                conn.commit()
+            conn.close()
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        return thread
+
+    def start_backup(self):
+        # Small steps with a pause make every step see a fresh write, so
+        # the copy restarts again and again
+        thread = threading.Thread(
+            target=online_backup, args=(self.dbPath, self.targetPath),
+            kwargs={'pages': 8, 'stepSleep': 0.002}, daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def assert_snapshot_ok(self):
+        self.assertFalse(METRICS.backup_in_progress())
+        self.assertFalse(os.path.exists(self.targetPath + '.partial'))
+        conn = sqlite3.connect(self.targetPath)
+        try:
+            self.assertEqual(
+                conn.execute('PRAGMA integrity_check').fetchone()[0], 'ok'
+            )
+            count = conn.execute('SELECT COUNT(*) FROM sale').fetchone()[0]
+        finally:
+            conn.close()
+        self.assertGreaterEqual(count, 2000)
+
+    def test_backup_switches_to_wal(self):
+        online_backup(self.dbPath, self.targetPath)
+        conn = sqlite3.connect(self.dbPath)
+        try:
+            mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(mode, 'wal')
+        self.assert_snapshot_ok()
+
+    def test_backup_completes_while_writes_happen(self):
+        # The first, idle backup switches the database to WAL
+        online_backup(self.dbPath, self.targetPath)
+        writerThread = self.start_writer()
+        backupThread = self.start_backup()
+        backupThread.join(timeout=30)
+        self.stop.set()
+        writerThread.join()
+
+        self.assertFalse(backupThread.is_alive(), 'backup never finished')
+        self.assert_snapshot_ok()
+
+    def test_backup_without_wal_keeps_stepping(self):
+        writerThread = self.start_writer()
+        with mock.patch('app.backup._ensure_wal', return_value=False):
+            backupThread = self.start_backup()
+            # A single-step copy would be done long before this
+            time.sleep(0.5)
+            self.assertTrue(backupThread.is_alive())
+            self.stop.set()
+            writerThread.join()
+            backupThread.join(timeout=30)
+
+        self.assertFalse(backupThread.is_alive(), 'backup never finished')
+        self.assert_snapshot_ok()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Checks for the chain-wide reports in app/federation.py.
+
+Run from the my_flask_app folder:
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app import federation
+from app.helper import get_base_dir
+
+# store -> [(date_and_time, [(name, price, quantity)])]
+SALES = {
+    'north': [
+        ('2024-01-01 10:00:00', [('Tea', 2.0, 2)]),
+        ('2024-01-08 11:00:00', [('Cake', 3.0, 1)]),
+    ],
+    'south': [
+        ('2024-01-01 15:00:00', [('Tea', 2.0, 1)]),
+        ('2024-02-01 09:00:00', [('Tea', 2.5, 3)]),
+    ],
+    'east': [],
+}
+
+
+class FederatedReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        schemaPath = os.path.join(get_base_dir(), 'database', 'database.sql')
+        with open(schemaPath, encoding='utf-8') as f:
+            schema = f.read()
+
+        self.paths = {}
+        for storeId, sales in SALES.items():
+            path = self.paths[storeId] = \
+                os.path.join(self.tmp.name, f'{storeId}.db')
+            conn = sqlite3.connect(path)
+            conn.executescript(schema)
+            for when, lines in sales:
+                cur = conn.execute(
+                    'INSERT INTO total_transaction '
+                    '(total_amount, date_and_time, payment_method) '
+                    'VALUES (?, ?, ?)',
+                    (sum(p * q for _, p, q in lines), when, 'cash'),
+                )
+                conn.executemany(
+                    'INSERT INTO each_transaction '
+                    '(name, transaction_id, price, quantity) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(n, cur.lastrowid, p, q) for n, p, q in lines],
+                )
+            conn.commit()
+            conn.close()
+
+        patcher = mock.patch.object(
+            federation, 'get_db_path', lambda storeId: self.paths[storeId]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_daily_report_sums_stores(self):
+        self.assertEqual(
+            federation.federated_sales_report(list(SALES)),
+            [
+                {'period': '2024-01-01', 'total_amount': 6.0,
+                 'total_quantity': 3},
+                {'period': '2024-01-08', 'total_amount': 3.0,
+                 'total_quantity': 1},
+                {'period': '2024-02-01', 'total_amount': 7.5,
+                 'total_quantity': 3},
+            ],
+        )
+
+    def test_monthly_report_merges_by_group_key(self):
+        self.assertEqual(
+            federation.federated_sales_report(
+                ['north', 'south'], group_by='monthly'
+            ),
+            [
+                {'period': '2024-01-01', 'total_amount': 9.0,
+                 'total_quantity': 4},
+                {'period': '2024-02-01', 'total_amount': 7.5,
+                 'total_quantity': 3},
+            ],
+        )
+
+    def test_all_group_is_one_row(self):
+        report = federation.federated_sales_report(
+            list(SALES), group_by='all'
+        )
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['total_amount'], 16.5)
+        self.assertEqual(report[0]['total_quantity'], 7)
+
+    def test_date_filter(self):
+        self.assertEqual(
+            federation.federated_sales_report(
+                list(SALES), start_date='2024-01-02', end_date='2024-01-31'
+            ),
+            [{'period': '2024-01-08', 'total_amount': 3.0,
+              'total_quantity': 1}],
+        )
+
+    def test_store_without_sales(self):
+        self.assertEqual(federation.federated_sales_report(['east']), [])
+        self.assertEqual(
+            federation.federated_sales_report(['east'], group_by='all'), []
+        )
+        self.assertEqual(federation.federated_transactions(['east']), [])
+
+    def test_transactions_sum_stores(self):
+        self.assertEqual(
+            federation.federated_transactions(list(SALES)),
+            [
+                {'period': '2024-01-01', 'name': 'Tea', 'quantity': 3,
+                 'price': 2.0, 'subtotal': 6.0},
+                {'period': '2024-01-08', 'name': 'Cake', 'quantity': 1,
+                 'price': 3.0, 'subtotal': 3.0},
+                {'period': '2024-02-01', 'name': 'Tea', 'quantity': 3,
+                 'price': 2.5, 'subtotal': 7.5},
+            ],
+        )
+
+
+class ReportPoolTest(unittest.TestCase):
+
+    def test_one_spawned_pool_for_concurrent_first_requests(self):
+        pools = []
+        with mock.patch.object(federation, '_pool', None):
+            threads = [
+                threading.Thread(
+                    target=lambda: pools.append(federation.get_pool())
+                )
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            pool = federation._pool
+        self.assertEqual({id(p) for p in pools}, {id(pool)})
+        self.assertEqual(pool._mp_context.get_start_method(), 'spawn')
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
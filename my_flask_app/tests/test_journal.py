@@ -0,0 +1,245 @@
+"""
+Checks for the write-ahead sale journal in app/journal.py.
+
+A journal opened with recover() and no applier stands for a process
+that journaled sales and then crashed before applying them.
+
+Run from the my_flask_app folder:
+    python -m unittest discover tests
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from app import management, sales
+from app.helper import connect_db, get_base_dir
+from app.journal import SaleJournal
+
+ITEMS = [{'product_id': 1, 'quantity': 2}]
+
+
+class SaleJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dbPath = os.path.join(self.tmp.name, 'shop.db')
+        self.journalPath = os.path.join(self.tmp.name, 'sale_journal.log')
+        schemaPath = os.path.join(get_base_dir(), 'database', 'database.sql')
+        with open(schemaPath, encoding='utf-8') as f:
+            schema = f.read()
+        conn = sqlite3.connect(self.dbPath)
+        conn.executescript(schema)
+        conn.executemany(
+            'INSERT INTO product (name, description, price, quantity) '
+            'VALUES (?, ?, ?, ?)',
+            [('Tea', 'Green tea', 2.0, 10), ('Cake', 'Lemon cake', 3.0, 10)],
+        )
+        conn.commit()
+        conn.close()
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.stop(timeout=5)
+        self.tmp.cleanup()
+
+    # -----------------------------
+    # Helpers
+    # -----------------------------
+
+    def journal(self, start=True):
+        journal = SaleJournal(dbPath=self.dbPath, journalPath=self.journalPath)
+        self.journals.append(journal)
+        if start:
+            journal.start()
+        else:
+            with journal._lock:
+                journal._recover()
+        return journal
+
+    def crash(self, journal):
+        """Drop a journal without letting it drain."""
+        journal._file.close()
+        journal._reader.close()
+        journal._file = journal._reader = None
+        self.journals.remove(journal)
+
+    def sell(self, journal, items=ITEMS, requestKey=None):
+        with mock.patch.object(sales, 'get_sale_journal', return_value=journal):
+            return sales.sell_products_journaled(
+                items, 'cash', request_key=requestKey
+            )
+
+    def wait_drained(self, journal, timeout=10):
+        deadline = time.monotonic() + timeout
+        while journal.status()['pending_entries']:
+            self.assertLess(time.monotonic(), deadline, 'journal not drained')
+            time.sleep(0.01)
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.dbPath)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def stock(self, productId):
+        return self.query(
+            f'SELECT quantity FROM product WHERE product_id = {productId}'
+        )[0][0]
+
+    # -----------------------------
+    # Checks
+    # -----------------------------
+
+    def test_replay_after_restart(self):
+        journal = self.journal(start=False)
+        results = [
+            self.sell(journal, requestKey=f'key-{n}') for n in range(3)
+        ]
+        self.crash(journal)
+
+        journal = self.journal()
+        self.wait_drained(journal)
+        journal.stop()
+        self.assertEqual(self.stock(1), 4)
+        self.assertEqual(
+            [row[0] for row in self.query(
+                'SELECT transaction_id FROM total_transaction ORDER BY 1'
+            )],
+            [result['transaction_id'] for result in results],
+        )
+        self.assertEqual(
+            self.query('SELECT COUNT(*) FROM checkout_request')[0][0], 3
+        )
+
+        # A second restart finds nothing left to apply
+        journal = self.journal()
+        self.assertEqual(journal.status()['pending_entries'], 0)
+        journal.stop()
+        self.assertEqual(
+            self.query('SELECT COUNT(*) FROM total_transaction')[0][0], 3
+        )
+
+    def test_crash_mid_append(self):
+        journal = self.journal(start=False)
+        self.sell(journal)
+        self.crash(journal)
+        # The process died while writing the next line
+        with open(self.journalPath, 'ab') as f:
+            f.write(b'{"seq":2,"transaction_id":2,"lin')
+
+        journal = self.journal(start=False)
+        self.assertEqual(journal.status()['pending_entries'], 1)
+        self.assertNotIn('error', self.sell(journal))
+        self.crash(journal)
+
+        with open(self.journalPath, 'rb') as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([entry['seq'] for entry in entries], [1, 2])
+
+        journal = self.journal()
+        self.wait_drained(journal)
+        self.assertEqual(self.stock(1), 6)
+
+    def test_failed_append_after_drain_leaves_no_padding(self):
+        journal = self.journal()
+        self.sell(journal)
+        self.wait_drained(journal)
+        self.assertEqual(os.path.getsize(self.journalPath), 0)
+
+        with mock.patch('app.journal.os.fsync', side_effect=OSError('disk')):
+            self.assertEqual(self.sell(journal)['error'], 'db_error')
+        self.assertEqual(os.path.getsize(self.journalPath), 0)
+
+        self.assertNotIn('error', self.sell(journal))
+        self.wait_drained(journal)
+        self.assertEqual(self.stock(1), 6)
+
+    def test_unappliable_entry_is_dead_lettered(self):
+        journal = self.journal()
+        # Keep the applier waiting while both sales are journaled
+        locker = sqlite3.connect(self.dbPath, isolation_level=None)
+        locker.execute('BEGIN IMMEDIATE')
+        bad = self.sell(journal, [{'product_id': 1, 'quantity': 5}])
+        good = self.sell(journal, [{'product_id': 2, 'quantity': 1}])
+        # Stock changed behind the journal's back: the first sale now
+        # breaks CHECK (quantity >= 0)
+        locker.execute('UPDATE product SET quantity = 2 WHERE product_id = 1')
+        locker.execute('COMMIT')
+        locker.close()
+
+        self.wait_drained(journal)
+        status = journal.status()
+        self.assertEqual(status['dead_letters'], 1)
+        self.assertEqual(
+            status['last_dead_letter']['transaction_id'],
+            bad['transaction_id'],
+        )
+        self.assertEqual(self.stock(1), 2)
+        self.assertEqual(self.stock(2), 9)
+        self.assertEqual(
+            self.query('SELECT transaction_id FROM total_transaction'),
+            [(good['transaction_id'],)],
+        )
+        with open(journal.get_dead_letter_path(), 'rb') as f:
+            deadLetters = [json.loads(line) for line in f]
+        self.assertEqual(
+            [entry['transaction_id'] for entry in deadLetters],
+            [bad['transaction_id']],
+        )
+
+        # The checkpoint moved past it, so a restart does not retry it
+        journal.stop()
+        journal = self.journal()
+        self.assertEqual(journal.status()['pending_entries'], 0)
+        self.assertEqual(journal.status()['dead_letters'], 1)
+
+    def test_pending_request_key_replay(self):
+        journal = self.journal(start=False)
+        first = self.sell(journal, requestKey='till-1')
+        again = self.sell(journal, requestKey='till-1')
+        self.assertTrue(again['idempotent_replay'])
+        self.assertEqual(again['transaction_id'], first['transaction_id'])
+        self.assertEqual(journal.status()['pending_entries'], 1)
+        self.assertEqual(
+            self.sell(journal, [{'product_id': 2, 'quantity': 1}],
+                      'till-1')['error'],
+            'idempotency_key_reused',
+        )
+
+        # Still pending after a crash: recovery rebuilds the key
+        self.crash(journal)
+        journal = self.journal(start=False)
+        again = self.sell(journal, requestKey='till-1')
+        self.assertTrue(again['idempotent_replay'])
+        self.assertEqual(again['transaction_id'], first['transaction_id'])
+        self.assertEqual(journal.status()['pending_entries'], 1)
+
+    def test_stock_edit_respects_pending_sales(self):
+        journal = self.journal(start=False)
+        self.sell(journal, [{'product_id': 1, 'quantity': 6}])
+
+        with mock.patch.object(management, 'get_sale_journal',
+                               return_value=journal), \
+                mock.patch.object(management, 'get_connection',
+                                  lambda: connect_db(self.dbPath)):
+            with self.assertRaises(ValueError):
+                management.modifyProduct(1, quantity=5)
+            self.assertEqual(
+                management.modifyProduct(1, quantity=6)['quantity'], 6
+            )
+
+        # All six units are held by the pending sale
+        self.assertIn('error', self.sell(journal, [
+            {'product_id': 1, 'quantity': 1}
+        ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Checks for checkout idempotency records in app/sales.py.
+
+Run from the my_flask_app folder:
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app import sales
+from app.helper import CHECKOUT_REQUEST_RETENTION, connect_db, \
+    get_base_dir, prune_checkout_requests
+
+
+def make_db(directory):
+    """Create an empty shop database and return its path."""
+    path = os.path.join(directory, 'shop.db')
+    schemaPath = os.path.join(get_base_dir(), 'database', 'database.sql')
+    with open(schemaPath, encoding='utf-8') as f:
+        schema = f.read()
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def checkout_result(transactionId, when):
+    return {
+        'transaction_id': transactionId,
+        'total_amount': 2.0,
+        'timestamp': when.isoformat(timespec='seconds'),
+    }
+
+
+class CheckoutRequestRetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dbPath = make_db(self.tmp.name)
+        self.old = datetime.now() - CHECKOUT_REQUEST_RETENTION \
+            - timedelta(hours=1)
+        self.recent = datetime.now() - timedelta(minutes=5)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stored_keys(self):
+        conn = sqlite3.connect(self.dbPath)
+        try:
+            return sorted(row[0] for row in conn.execute(
+                'SELECT request_key FROM checkout_request'
+            ))
+        finally:
+            conn.close()
+
+    def store(self, conn, key, transactionId, when):
+        sales.store_checkout_result(
+            conn.cursor(), key, 'hash', checkout_result(transactionId, when)
+        )
+        conn.commit()
+
+    def test_prune_deletes_only_expired_results(self):
+        conn = sqlite3.connect(self.dbPath)
+        self.store(conn, 'old', 1, self.old)
+        self.store(conn, 'recent', 2, self.recent)
+        self.assertEqual(prune_checkout_requests(conn), 1)
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.stored_keys(), ['recent'])
+
+    def test_first_open_prunes(self):
+        conn = sqlite3.connect(self.dbPath)
+        self.store(conn, 'old', 1, self.old)
+        conn.close()
+        connect_db(self.dbPath).close()
+        self.assertEqual(self.stored_keys(), [])
+
+    def test_storing_results_prunes_every_so_often(self):
+        conn = sqlite3.connect(self.dbPath)
+        self.store(conn, 'old', 1, self.old)
+        with mock.patch.object(sales, 'CHECKOUT_REQUEST_PRUNE_EVERY', 1):
+            self.store(conn, 'recent', 2, self.recent)
+        conn.close()
+        self.assertEqual(self.stored_keys(), ['recent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
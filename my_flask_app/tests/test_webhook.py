@@ -0,0 +1,126 @@
+"""
+Checks for the QR payment webhook and the manual mark-paid endpoint in
+app/sales.py.
+
+Run from the my_flask_app folder:
+    python -m unittest discover tests
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import time
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+from flask import Flask
+
+from app import sales
+
+SECRET = 'test-secret'
+
+
+class PaymentWebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.register_blueprint(sales.sales_bp)
+        self.client = app.test_client()
+
+        patchers = [
+            mock.patch.object(sales, 'TX_STATUS', {}),
+            mock.patch.object(sales, 'SEEN_WEBHOOK_EVENTS', OrderedDict()),
+            mock.patch.dict(os.environ, {'SMARTVISION_WEBHOOK_SECRET': SECRET}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.environ.pop('SMARTVISION_ALLOW_MARK_PAID', None)
+        sales.TX_STATUS[('default', 7)] = {
+            'status': 'pending', 'amount': 12.5, 'created': time.time(),
+        }
+
+    # -----------------------------
+    # Helpers
+    # -----------------------------
+
+    def post_event(self, event, secret=SECRET):
+        body = json.dumps(event).encode('utf-8')
+        signature = hmac.new(
+            secret.encode('utf-8'), body, hashlib.sha256
+        ).hexdigest()
+        return self.client.post(
+            '/api/sales/payment-webhook', data=body,
+            content_type='application/json',
+            headers={'X-Signature': signature},
+        )
+
+    def event(self, eventId='evt-1', status='paid', amount=12.5):
+        return {'event_id': eventId, 'transaction_id': 7,
+                'status': status, 'amount': amount}
+
+    def status(self):
+        return sales.TX_STATUS[('default', 7)]['status']
+
+    # -----------------------------
+    # Checks
+    # -----------------------------
+
+    def test_refused_without_secret(self):
+        del os.environ['SMARTVISION_WEBHOOK_SECRET']
+        res = self.post_event(self.event())
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(res.get_json()['error'], 'webhook_disabled')
+        self.assertEqual(self.status(), 'pending')
+
+    def test_refused_with_bad_signature(self):
+        res = self.post_event(self.event(), secret='wrong-secret')
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.get_json()['error'], 'bad_signature')
+
+        res = self.client.post('/api/sales/payment-webhook',
+                               json=self.event())
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(self.status(), 'pending')
+        self.assertEqual(len(sales.SEEN_WEBHOOK_EVENTS), 0)
+
+    def test_duplicate_event_is_applied_once(self):
+        res = self.post_event(self.event(status='failed'))
+        self.assertEqual(res.get_json(), {'ok': True, 'status': 'failed'})
+
+        # The redelivery is acknowledged but not applied again
+        sales.TX_STATUS[('default', 7)]['status'] = 'pending'
+        res = self.post_event(self.event(status='failed'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {'ok': True, 'duplicate': True})
+        self.assertEqual(self.status(), 'pending')
+
+    def test_amount_mismatch_is_not_recorded(self):
+        res = self.post_event(self.event(amount=1.0))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['error'], 'amount_mismatch')
+        self.assertEqual(self.status(), 'pending')
+        self.assertNotIn('evt-1', sales.SEEN_WEBHOOK_EVENTS)
+
+        # A corrected retry under the same event id still counts
+        res = self.post_event(self.event())
+        self.assertEqual(res.get_json(), {'ok': True, 'status': 'paid'})
+        self.assertEqual(self.status(), 'paid')
+
+    def test_mark_paid_needs_development_setting(self):
+        res = self.client.post('/api/sales/mark-paid/7')
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(res.get_json()['error'], 'mark_paid_disabled')
+        self.assertEqual(self.status(), 'pending')
+
+        with mock.patch.dict(os.environ,
+                             {'SMARTVISION_ALLOW_MARK_PAID': '1'}):
+            res = self.client.post('/api/sales/mark-paid/7')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.status(), 'paid')
+
+
+if __name__ == '__main__':
+    unittest.main()
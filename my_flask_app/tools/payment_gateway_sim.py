@@ -0,0 +1,288 @@
+"""
+payment_gateway_sim.py
+
+Local stand-in for a QR payment gateway, for testing the QR checkout
+flow without a real bank.
+
+A client (the load harness, or a person with curl) "scans" a QR code by
+posting its payload to /pay. After a configurable delay the simulator
+calls the POS payment webhook with the result, the way a real gateway
+would. It can decline payments, lose webhook deliveries (which are then
+retried with backoff) and deliver the same event twice.
+
+Usage (run from the my_flask_app folder while run.py is serving, with
+the same SMARTVISION_WEBHOOK_SECRET in the environment of both):
+    python tools/payment_gateway_sim.py --port 5100 --latency-ms 800 \\
+        --decline-rate 0.05 --drop-rate 0.1 --duplicate-rate 0.1
+
+    curl -X POST localhost:5100/pay -d '{"payload": "PAYMENT|TX:1|AMT:9.50"}'
+    curl localhost:5100/stats
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBHOOK_PATH = '/api/sales/payment-webhook'
+
+# Delivery retry schedule for lost or rejected webhooks (seconds)
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+MAX_ATTEMPTS = 8
+
+
+def parse_payload(payload):
+    """
+    Return (transaction_id, amount, store_id) from a POS QR payload.
+    """
+    fields = dict(
+        part.split(':', 1) for part in payload.split('|')[1:] if ':' in part
+    )
+    return int(fields['TX']), float(fields['AMT']), fields.get('STORE')
+
+
+class GatewaySimulator:
+    """
+    Simulated gateway: accepts payments and sends webhook callbacks.
+    """
+
+    def __init__(self, posUrl='http://127.0.0.1:5000', latencyMs=500,
+                 jitterMs=250, declineRate=0.0, dropRate=0.0,
+                 duplicateRate=0.0, secret=None, seed=None):
+        self.posUrl = posUrl.rstrip('/')
+        self.latencyMs = latencyMs
+        self.jitterMs = jitterMs
+        self.declineRate = declineRate
+        self.dropRate = dropRate
+        self.duplicateRate = duplicateRate
+        self.secret = secret
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.stats = {
+            'payments': 0,
+            'declined': 0,
+            'deliveries': 0,
+            'delivered': 0,
+            'dropped': 0,
+            'rejected': 0,
+            'duplicates_sent': 0,
+            'gave_up': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def _delay(self):
+        with self._lock:
+            jitter = self._random.uniform(-self.jitterMs, self.jitterMs)
+        return max(0.0, self.latencyMs + jitter) / 1000
+
+    # -----------------------------
+    # Payments and webhooks
+    # -----------------------------
+
+    def pay(self, payload):
+        """
+        Accept a scanned payload and schedule its webhook.
+        """
+        transactionId, amount, storeId = parse_payload(payload)
+        declined = self._chance(self.declineRate)
+        event = {
+            'event_id': uuid.uuid4().hex,
+            'transaction_id': transactionId,
+            'status': 'failed' if declined else 'paid',
+            'amount': amount,
+        }
+        self._count('payments')
+        if declined:
+            self._count('declined')
+
+        self._schedule(event, storeId, self._delay(), 1)
+        if self._chance(self.duplicateRate):
+            self._count('duplicates_sent')
+            self._schedule(event, storeId, self._delay(), 1)
+        return event
+
+    def _schedule(self, event, storeId, delay, attempt):
+        timer = threading.Timer(
+            delay, self._deliver, args=(event, storeId, attempt)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def _deliver(self, event, storeId, attempt):
+        """
+        Send one webhook attempt, retrying with backoff on failure.
+        """
+        self._count('deliveries')
+        if self._chance(self.dropRate):
+            # Simulated network loss: the POS never sees this attempt
+            self._count('dropped')
+            outcome = 'retry'
+        else:
+            outcome = self._post_webhook(event, storeId)
+
+        if outcome == 'delivered':
+            self._count('delivered')
+        elif outcome == 'rejected':
+            self._count('rejected')
+        elif attempt < MAX_ATTEMPTS:
+            delay = min(RETRY_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+            self._schedule(event, storeId, delay, attempt + 1)
+        else:
+            self._count('gave_up')
+
+    def _post_webhook(self, event, storeId):
+        """
+        POST the event; return 'delivered', 'rejected' or 'retry'.
+        """
+        body = json.dumps(event).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if storeId:
+            headers['X-Store-Id'] = storeId
+        if self.secret:
+            headers['X-Signature'] = hmac.new(
+                self.secret.encode('utf-8'), body, hashlib.sha256
+            ).hexdigest()
+        req = urllib.request.Request(
+            self.posUrl + WEBHOOK_PATH, data=body, headers=headers,
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=10):
+                return 'delivered'
+        except urllib.error.HTTPError as e:
+            # Other 4xx answers will not change on retry; a 404 can be
+            # a sale the POS has not registered yet
+            if 400 <= e.code < 500 and e.code != 404:
+                return 'rejected'
+            return 'retry'
+        except (urllib.error.URLError, OSError):
+            return 'retry'
+
+    # -----------------------------
+    # HTTP server
+    # -----------------------------
+
+    def start(self, host='127.0.0.1', port=5100):
+        """
+        Serve /pay and /stats in a background thread; returns the URL.
+        """
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != '/pay':
+                    return self._reply(404, {'error': 'not_found'})
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    data = json.loads(self.rfile.read(length))
+                    event = gateway.pay(data['payload'])
+                except (KeyError, ValueError, TypeError) as e:
+                    return self._reply(400, {'error': str(e)})
+                self._reply(202, {'event_id': event['event_id']})
+
+            def do_GET(self):
+                if self.path != '/stats':
+                    return self._reply(404, {'error': 'not_found'})
+                with gateway._lock:
+                    stats = dict(gateway.stats)
+                self._reply(200, stats)
+
+            def _reply(self, code, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name='gateway-sim',
+            daemon=True,
+        ).start()
+        return f'http://{host}:{self._server.server_address[1]}'
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def add_gateway_arguments(parser):
+    """
+    Add the simulator's behaviour options to an argument parser.
+    """
+    parser.add_argument('--pos-url', default='http://127.0.0.1:5000',
+                        help='POS server that receives the webhooks')
+    parser.add_argument('--latency-ms', type=float, default=500,
+                        help='mean delay before a webhook is sent')
+    parser.add_argument('--jitter-ms', type=float, default=250,
+                        help='uniform +/- variation of the delay')
+    parser.add_argument('--decline-rate', type=float, default=0.0,
+                        help='share of payments reported as failed')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='share of webhook attempts lost in transit')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0,
+                        help='share of events delivered twice')
+    parser.add_argument('--secret',
+                        default=os.environ.get('SMARTVISION_WEBHOOK_SECRET'),
+                        help='webhook signing secret (default: '
+                             '$SMARTVISION_WEBHOOK_SECRET, as the POS uses)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for repeatable runs')
+
+
+def gateway_from_args(args):
+    return GatewaySimulator(
+        posUrl=args.pos_url,
+        latencyMs=args.latency_ms,
+        jitterMs=args.jitter_ms,
+        declineRate=args.decline_rate,
+        dropRate=args.drop_rate,
+        duplicateRate=args.duplicate_rate,
+        secret=args.secret,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5100)
+    add_gateway_arguments(parser)
+    args = parser.parse_args()
+
+    gateway = gateway_from_args(args)
+    url = gateway.start(args.host, args.port)
+    print(f'Payment gateway simulator listening on {url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        gateway.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+qr_load_harness.py
+
+Load test for the QR checkout flow, end to end over HTTP.
+
+Each simulated register checks out a basket with payment_method "qr",
+"scans" the returned QR payload with the payment gateway simulator and
+polls /api/sales/status until the payment is confirmed. At the end it
+reports time-to-confirmed-payment percentiles, the server CPU spent
+rendering QR images and how the server's pending-payment state grew.
+
+Usage (run from the my_flask_app folder while run.py is serving, with
+the same SMARTVISION_WEBHOOK_SECRET in the environment of both; the
+product must have enough stock for every checkout):
+    python tools/qr_load_harness.py --payments 500 --concurrency 100 \\
+        --product-id 1 --latency-ms 800 --drop-rate 0.1 --duplicate-rate 0.1
+
+By default a gateway simulator is started inside the harness; use
+--gateway-url to drive one that is already running.
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from payment_gateway_sim import add_gateway_arguments, gateway_from_args
+
+# Statuses after which a QR transaction will not change any more
+FINAL_STATUSES = {'paid', 'failed', 'canceled', 'expired'}
+
+
+def percentile(samples, pct):
+    """
+    Return the pct-th percentile of samples (nearest rank).
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class QrLoadHarness:
+    """
+    Drive concurrent QR checkouts and collect their timings.
+    """
+
+    def __init__(self, posUrl, gatewayUrl, storeId=None, productId=1,
+                 quantity=1, pollInterval=0.2, timeout=60):
+        self.posUrl = posUrl.rstrip('/')
+        self.gatewayUrl = gatewayUrl.rstrip('/')
+        self.storeId = storeId
+        self.productId = productId
+        self.quantity = quantity
+        self.pollInterval = pollInterval
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self.confirmSeconds = []
+        self.checkoutSeconds = []
+        self.outcomes = {}
+        self.errors = []
+        self.stateSamples = []
+
+    # -----------------------------
+    # HTTP helpers
+    # -----------------------------
+
+    def _request(self, url, data=None, headers=None):
+        headers = dict(headers or {})
+        if self.storeId:
+            headers['X-Store-Id'] = self.storeId
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(url, data=body, headers=headers)
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return json.loads(resp.read())
+
+    def server_metrics(self):
+        return self._request(f'{self.posUrl}/api/sales/qr-metrics')
+
+    # -----------------------------
+    # One simulated customer
+    # -----------------------------
+
+    def _record(self, outcome, confirmSeconds=None, checkoutSeconds=None,
+                error=None):
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if confirmSeconds is not None:
+                self.confirmSeconds.append(confirmSeconds)
+            if checkoutSeconds is not None:
+                self.checkoutSeconds.append(checkoutSeconds)
+            if error and len(self.errors) < 10:
+                self.errors.append(error)
+
+    def run_one(self, _):
+        """
+        Check out, pay through the gateway and wait for confirmation.
+        """
+        started = time.perf_counter()
+        try:
+            sale = self._request(
+                f'{self.posUrl}/api/sales/checkout',
+                {
+                    'items': [{'product_id': self.productId,
+                               'quantity': self.quantity}],
+                    'payment_method': 'qr',
+                },
+                {'Idempotency-Key': uuid.uuid4().hex},
+            )
+            checkoutSeconds = time.perf_counter() - started
+            self._request(
+                f'{self.gatewayUrl}/pay', {'payload': sale['qr_payload']}
+            )
+
+            statusUrl = \
+                f"{self.posUrl}/api/sales/status/{sale['transaction_id']}"
+            while time.perf_counter() - started < self.timeout:
+                status = self._request(statusUrl)['status']
+                if status in FINAL_STATUSES:
+                    confirmed = time.perf_counter() - started
+                    self._record(
+                        status,
+                        confirmed if status == 'paid' else None,
+                        checkoutSeconds,
+                    )
+                    return
+                time.sleep(self.pollInterval)
+            self._record('timeout', checkoutSeconds=checkoutSeconds)
+        except urllib.error.HTTPError as e:
+            self._record('error', error=f'HTTP {e.code}: {e.read()[:200]!r}')
+        except (urllib.error.URLError, OSError, KeyError, ValueError) as e:
+            self._record('error', error=repr(e))
+
+    # -----------------------------
+    # Whole run
+    # -----------------------------
+
+    def _sample_state(self, stop, interval):
+        while not stop.wait(interval):
+            try:
+                metrics = self.server_metrics()
+            except (urllib.error.URLError, OSError, ValueError):
+                continue
+            with self._lock:
+                self.stateSamples.append(
+                    (metrics['tx_status_entries'], metrics['tx_status_bytes'])
+                )
+
+    def run(self, payments, concurrency, sampleInterval=1.0):
+        """
+        Run the load and return a report dict.
+        """
+        before = self.server_metrics()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample_state, args=(stop, sampleInterval),
+            daemon=True,
+        )
+        sampler.start()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self.run_one, range(payments)))
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        sampler.join()
+        after = self.server_metrics()
+
+        renders = after['qr_renders'] - before['qr_renders']
+        renderCpuMs = \
+            after['qr_render_cpu_ms_total'] - before['qr_render_cpu_ms_total']
+        peakBytes = max(
+            [b for _, b in self.stateSamples] + [after['tx_status_bytes']]
+        )
+        return {
+            'payments': payments,
+            'concurrency': concurrency,
+            'elapsed_s': round(elapsed, 2),
+            'throughput_per_s': round(payments / elapsed, 2),
+            'outcomes': self.outcomes,
+            'time_to_confirmed_ms': {
+                f'p{p}': round(percentile(self.confirmSeconds, p) * 1000, 1)
+                for p in (50, 90, 95, 99, 100)
+            },
+            'checkout_ms': {
+                f'p{p}': round(percentile(self.checkoutSeconds, p) * 1000, 1)
+                for p in (50, 95, 99)
+            },
+            'server_qr_render': {
+                'renders': renders,
+                'cpu_ms_total': round(renderCpuMs, 2),
+                'cpu_ms_per_render':
+                    round(renderCpuMs / renders, 3) if renders else 0.0,
+            },
+            'server_pending_state': {
+                'entries_before': before['tx_status_entries'],
+                'entries_after': after['tx_status_entries'],
+                'bytes_before': before['tx_status_bytes'],
+                'bytes_after': after['tx_status_bytes'],
+                'bytes_peak': peakBytes,
+                'bytes_growth': after['tx_status_bytes']
+                - before['tx_status_bytes'],
+                'by_status': after['tx_status_by_status'],
+            },
+            'server_webhooks': {
+                'received': after['webhooks_received']
+                - before['webhooks_received'],
+                'duplicates': after['webhook_duplicates']
+                - before['webhook_duplicates'],
+            },
+            'errors': self.errors,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--payments', type=int, default=200,
+                        help='number of QR checkouts in total')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='number of registers checking out at once')
+    parser.add_argument('--store', default=None,
+                        help='store id to check out in (X-Store-Id)')
+    parser.add_argument('--product-id', type=int, default=1)
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--poll-interval', type=float, default=0.2,
+                        help='seconds between status polls')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='give up on a payment after this many seconds')
+    parser.add_argument('--gateway-url', default=None,
+                        help='use a running gateway simulator instead')
+    add_gateway_arguments(parser)
+    args = parser.parse_args()
+
+    gateway = None
+    gatewayUrl = args.gateway_url
+    if not gatewayUrl:
+        gateway = gateway_from_args(args)
+        gatewayUrl = gateway.start(port=0)
+
+    harness = QrLoadHarness(
+        args.pos_url, gatewayUrl, storeId=args.store,
+        productId=args.product_id, quantity=args.quantity,
+        pollInterval=args.poll_interval, timeout=args.timeout,
+    )
+    report = harness.run(args.payments, args.concurrency)
+    if gateway:
+        report['gateway'] = dict(gateway.stats)
+        gateway.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()